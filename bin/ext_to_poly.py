@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 """Create a polygon from image file extents
 
+Extents are streamed from -infn (or stdin, '-') and written in batches of
+-batch features per transaction, e.g.:
+
+    cat extents.txt | ext_to_poly.py -infn - -outfn extents.gpkg -f GPKG -srs EPSG:2193
 """
 # Author: James Shepherd
 
-import os, re
+import os, re, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from osgeo import ogr
 from osgeo import osr
 import argparse
@@ -14,13 +21,16 @@ def write_to_file(args, lines):
 
     ds = drv.CreateDataSource(args.outfn)
     sr = osr.SpatialReference()
-    sr.ImportFromEPSG(2193)
+    sr.SetFromUserInput(args.srs)
+    sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
     lyr = ds.CreateLayer("ext_to_poly", sr, ogr.wkbPolygon)
 
     field_defn = ogr.FieldDefn("Name", ogr.OFTString)
     lyr.CreateField(field_defn)
    
-
+    # one transaction per batch of features (a no-op for formats without them)
+    count = 0
+    lyr.StartTransaction()
     for line in lines:
         ext = line[:4]
         
@@ -41,58 +51,95 @@ def write_to_file(args, lines):
         feat.SetGeometry(poly)
         lyr.CreateFeature(feat)
         feat.Destroy()
+
+        count += 1
+        if count % args.batch == 0:
+            lyr.CommitTransaction()
+            lyr.StartTransaction()
+    lyr.CommitTransaction()
         
     ds.Destroy()
+    return count
+
+def read_lines(args):
+    """Yield raw extent lines from -infn, stdin or (if stdin is a terminal) manual input"""
+    if args.infn is not None and args.infn != '-':
+        with open(args.infn, 'r') as handle:
+            yield from handle
+    elif args.infn == '-' or not sys.stdin.isatty():
+        yield from sys.stdin
+    else:
+        print('Manual input (q to quit at any time)')
+        while True:
+            try:
+                a = input('tl_x tl_y br_x br_y [name - optional]')
+                if a.endswith('q'):
+                    raise Exception()
+                else:
+                    yield a
+                    
+            except Exception as ex:
+                print(ex)
+                if input('Continue? (y|n) [n]') != 'y':
+                    break
+
+def write_separate(args, lines):
+    """Write each line to its own file, in a pool of -j threads"""
+    orig_out = os.path.splitext(args.outfn)
+
+    def write(line):
+        line_args = argparse.Namespace(**vars(args))
+        line_args.outfn = '{0}.{1}{2}'.format(orig_out[0], line[-1], orig_out[1])
+        if os.path.exists(line_args.outfn):
+            os.remove(line_args.outfn)
+        return write_to_file(line_args, [line])
+
+    def unique(lines):
+        # two lines with the same name would be written to the same file at once
+        names = set()
+        for line in lines:
+            if line[-1] in names:
+                raise Exception(f"Duplicate name '{line[-1]}', -separate needs a unique name per line")
+            names.add(line[-1])
+            yield line
+
+    # a bounded number of lines in flight, so the input is still streamed
+    with ThreadPoolExecutor(max_workers=args.j) as pool:
+        lines = unique(lines)
+        queue = deque(pool.submit(write, line) for line in islice(lines, args.j * 4))
+        while queue:
+            queue.popleft().result()
+            queue.extend(pool.submit(write, line) for line in islice(lines, 1))
     
 parser = argparse.ArgumentParser()
-parser.add_argument("-infn", help="-infn filename  : white-space separated extents, format: tl_x tl_y br_x br_y [optional name]", default=None)
+parser.add_argument("-infn", help="-infn filename  : white-space separated extents, format: tl_x tl_y br_x br_y [optional name], '-' for stdin (also read if piped)", default=None)
 parser.add_argument("-outfn", help="-outfn filename  : default 'temp.kml'", default='temp.gml')
 parser.add_argument("-f", help="-f \"OGR Format\" : default GML", default='GML')
 parser.add_argument("-separate", help="-separate : create file for each line of input : default False", action='store_true', default=False)
+parser.add_argument("-srs", help="-srs SRS : any OGR SRS definition (e.g. EPSG:4326, WKT, PROJ) : default EPSG:2193", default='EPSG:2193')
+parser.add_argument("-batch", help="-batch N : features per transaction (e.g. GPKG) : default 10000", type=int, default=10000)
+parser.add_argument("-j", help="-j N : threads writing -separate files : default 4", type=int, default=4)
 
 args = parser.parse_args()
+if args.batch < 1:
+    parser.error("-batch must be at least 1")
+if args.j < 1:
+    parser.error("-j must be at least 1")
 
-readfromfile = True if args.infn else False
-
-if os.path.exists(args.outfn):
+if os.path.exists(args.outfn) and not args.separate:
     os.remove(args.outfn)
 
-lines = None
-if readfromfile:
-    with open(args.infn, 'r') as handle:
-        lines = handle.readlines()
-        
-else:
-    lines = []
-    print('Manual input (q to quit at any time)')
-    while True:
-        try:
-            a = input('tl_x tl_y br_x br_y [name - optional]')
-            if a.endswith('q'):
-                raise Exception()
-            else:
-                lines.append(a)
-                
-        except Exception as ex:
-            print(ex)
-            if input('Continue? (y|n) [n]') != 'y':
-                break
-
-#get and split lines of extents to read
-lines = (re.split('\s+', x.strip()) for x in lines)
+#get and split lines of extents to read (streamed, nothing is held in memory)
+lines = (re.split('\s+', x.strip()) for x in read_lines(args))
 #skip any that aren't the right length (useful for leading/tailing blanks)
 lines = (line for line in lines if len(line) in [4,5])
 #make names up (based in line idx) for lines that don't have names
-lines = (line if len(line) == 4 else (line + ['f'+str(i)]) for i, line in enumerate(lines))
+lines = (line if len(line) == 5 else (line + ['f'+str(i)]) for i, line in enumerate(lines))
 #convert the extents to float
-lines = [[float(x) for x in line[:4]] + [line[4]] for i, line in enumerate(lines)]
+lines = ([float(x) for x in line[:4]] + [line[4]] for i, line in enumerate(lines))
 
 if args.separate:
-    orig_out = os.path.splitext(args.out)
-    
-    for line in lines:
-        args.outfn = '{0}.{1}.{2}'.format(orig_out[0], line[-1], orig_out[1])
-        write_to_file(args, [line])
+    write_separate(args, lines)
 else:
     write_to_file(args, lines)
 
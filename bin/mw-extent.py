@@ -10,11 +10,22 @@ Usage:
     mw-extent.py ~/nz_sen2_arefs_1920_100m.kea
     OR (create KML)
     mw-extent.py ~/nz_sen2_arefs_1920_100m.kea --output ~/nz_sen2_arefs_1920_100m.kml -of KML --epsg 4326
+    OR (reprojected bounds that follow the curved edges)
+    mw-extent.py ~/nz_sen2_arefs_1920_100m.kea --epsg 4326 --densify 20
+    OR (outlines of the valid (not nodata) pixels instead of the whole extent)
+    mw-extent.py /scenes/*.tif --footprint --output footprints.gpkg -of GPKG
+    OR (tile index, only new/changed tiles are scanned and rewritten on reruns)
+    mw-extent.py /archive/*.kea --output index.gpkg -of GPKG --update --cache index.json --threads 16
 """
 # Author: Ben Jolly
 
 import argparse
+import json
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 """The following block is borrowed/modified from StackExchange
 
@@ -23,25 +34,31 @@ https://gis.stackexchange.com/questions/57834/how-to-get-raster-corner-coordinat
 from osgeo import gdal,ogr,osr
 gdal.UseExceptions()
 
-def GetExtent(images, buffer=0, tap=False, epsg=None, tap_size=None):
-    """ Return list of corner coordinates from a gdal Dataset (ul ur lr ll) """
+def GetExtent(images, buffer=0, tap=False, epsg=None, tap_size=None, infos=None, threads=1, densify=0):
+    """ Return list of corner coordinates from a gdal Dataset (ul ur lr ll)
+
+    With `densify`, each edge also has that many points between the
+    corners (ul ... ur ... lr ... ll ...), so reprojected outlines and
+    bounds follow the curved edges.
+    """
 
     if epsg is None:
         tgt_srs = None
     else:
         tgt_srs = osr.SpatialReference()
         tgt_srs.ImportFromEPSG(epsg)
+        # x/y (lon/lat) order, whatever the EPSG definition says
+        tgt_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    if infos is None:
+        infos = scan_images(images, threads)
 
     extents = []
     
-    for image in images:
-        ds = gdal.Open(image)
-        
-        src_srs=osr.SpatialReference()
-        src_srs.ImportFromWkt(ds.GetProjection())
+    for info in infos:
 
-        xmin, xpixel, _, ymax, _, ypixel = ds.GetGeoTransform()
-        width, height = ds.RasterXSize, ds.RasterYSize
+        xmin, xpixel, _, ymax, _, ypixel = info['transform']
+        width, height = info['size']
         xmax = xmin + width * xpixel
         ymin = ymax + height * ypixel
 
@@ -61,58 +78,275 @@ def GetExtent(images, buffer=0, tap=False, epsg=None, tap_size=None):
 
         #              ul            ur            lr            ll
         corners = (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)
+        if densify > 0:
+            steps = np.linspace(0, 1, densify + 2)[:-1, np.newaxis]
+            corners = np.concatenate([np.asarray(a) + steps * (np.asarray(b) - np.asarray(a))
+                for a, b in zip(corners, corners[1:] + corners[:1])])
         
-        if epsg is None:
-            if tgt_srs is None:
-                tgt_srs = src_srs.CloneGeogCS()
-        else:                   
-            corners = ReprojectCoords(corners, src_srs, tgt_srs)
-
         extents.append(corners)
 
+    if epsg is None:
+        if tgt_srs is None and infos:
+            tgt_srs = wkt_srs(infos[0]['wkt'])
+        return extents, tgt_srs
+
+    # every image in the same SRS is reprojected in one batch
+    for wkt in set(info['wkt'] for info in infos):
+        ids = [i for i, info in enumerate(infos) if info['wkt'] == wkt]
+        coords = ReprojectCoords(np.concatenate([extents[i] for i in ids]), wkt_srs(wkt), tgt_srs)
+        offsets = np.cumsum([0] + [len(extents[i]) for i in ids])
+        for i, start, end in zip(ids, offsets[:-1], offsets[1:]):
+            extents[i] = coords[start:end]
+
     return extents, tgt_srs
+
+# (src, tgt) WKT -> osr.CoordinateTransformation
+_transforms = {}
+
+def wkt_srs(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def get_transform(src_srs, tgt_srs):
+    """ Cached osr.CoordinateTransformation for each pair of SRS """
+    key = (src_srs.ExportToWkt(), tgt_srs.ExportToWkt())
+    if key not in _transforms:
+        _transforms[key] = osr.CoordinateTransformation(src_srs, tgt_srs)
+    return _transforms[key]
         
 def ReprojectCoords(coords,src_srs,tgt_srs):
-    """ Reproject a list of x,y coordinates. """
-    trans_coords=[]
-    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
+    """ Reproject a list (or (n, 2) array) of x,y coordinates in one batch. """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return coords
+    return np.array(get_transform(src_srs, tgt_srs).TransformPoints(coords))[:, :2]
 
 
 """StackExchange block done"""
 
 
-def create_vector(extents, srs, vector_file, format, layer_name, feature_names):
-    """Create a polygon from a set of corner and write to an OGR vector file"""
-    drv = ogr.GetDriverByName(format)
-    ds = drv.CreateDataSource(vector_file)
-    lyr = ds.CreateLayer(layer_name, srs, ogr.wkbPolygon)
-
-    field_defn = ogr.FieldDefn("Name", ogr.OFTString)
-    lyr.CreateField(field_defn)
+def image_footprint(image, max_size=1024, simplify=None, buffer=0):
+    """WKT (multi)polygon outline of the valid pixels of an image, in its own SRS
+
+    Valid pixels come from the first band's mask band (nodata, alpha or a
+    .msk), read at most `max_size` pixels across so GDAL uses a coarse
+    overview of it where there is one. The outline is simplified to
+    `simplify` CRS units [default: the coarse pixel size].
+    """
+    ds = gdal.Open(image)
+    mask = ds.GetRasterBand(1).GetMaskBand()
+    scale = max(1, max(ds.RasterXSize, ds.RasterYSize) / max_size)
+    width, height = max(1, round(ds.RasterXSize / scale)), max(1, round(ds.RasterYSize / scale))
+    valid = (mask.ReadAsArray(buf_xsize=width, buf_ysize=height) > 0).astype(np.uint8)
+
+    xmin, xpixel, xrot, ymax, yrot, ypixel = ds.GetGeoTransform()
+    xpixel, ypixel = xpixel * ds.RasterXSize / width, ypixel * ds.RasterYSize / height
+    mem = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    mem.SetGeoTransform((xmin, xpixel, xrot, ymax, yrot, ypixel))
+    mem.GetRasterBand(1).WriteArray(valid)
+
+    src = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = src.CreateLayer('footprint', geom_type=ogr.wkbPolygon)
+    lyr.CreateField(ogr.FieldDefn("valid", ogr.OFTInteger))
+    gdal.Polygonize(mem.GetRasterBand(1), mem.GetRasterBand(1), lyr, 0)
+
+    footprint = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feat in lyr:
+        footprint.AddGeometry(feat.GetGeometryRef())
+    footprint = footprint.UnionCascaded() if not footprint.IsEmpty() else footprint
+    footprint = footprint.SimplifyPreserveTopology(abs(xpixel) if simplify is None else simplify)
+    if buffer != 0:
+        footprint = footprint.Buffer(buffer)
+    return ogr.ForceToMultiPolygon(footprint).ExportToWkt()
+
+
+def GetFootprint(images, infos, epsg=None, threads=1, max_size=1024, simplify=None, buffer=0):
+    """ Return list of valid-data footprints (ogr.Geometry) of images, traced in a pool of threads
+
+    Footprints already traced with the same options by scan_images() (and
+    so cached) are reused.
+    """
+    options = [max_size, simplify, buffer]
+
+    def trace(image, info):
+        cached = info.get('footprint')
+        if cached is not None and cached['options'] == options:
+            return cached['wkt']
+        return image_footprint(image, max_size, simplify, buffer)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        wkts = list(pool.map(trace, images, infos))
 
+    if epsg is None:
+        tgt_srs = wkt_srs(infos[0]['wkt']) if infos else None
+    else:
+        tgt_srs = osr.SpatialReference()
+        tgt_srs.ImportFromEPSG(epsg)
+        tgt_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    footprints = []
+    for wkt, info in zip(wkts, infos):
+        footprint = ogr.CreateGeometryFromWkt(wkt)
+        if epsg is not None and not footprint.IsEmpty():
+            footprint.Transform(get_transform(wkt_srs(info['wkt']), tgt_srs))
+        footprints.append(footprint)
+    return footprints, tgt_srs
+
+
+def image_stamp(image):
+    """(mtime, size) of an image file, works for /vsi paths too
+
+    None for names that aren't files (e.g. HDF4_EOS:..., NETCDF:"f.nc":var).
+    """
+    stat = gdal.VSIStatL(image)
+    return [stat.mtime, stat.size] if stat is not None else None
+
+
+def image_location(image):
+    """Absolute path of an image file, other names (/vsi paths, HDF4_EOS:... subdatasets) as given"""
+    if '/vsi' in image or gdal.VSIStatL(image) is None:
+        return image
+    return os.path.abspath(image)
+
+
+def image_info(image):
+    """Metadata (no pixels are read) needed for the extent of an image"""
+    ds = gdal.Open(image)
+    return {'wkt': ds.GetProjection(), 'transform': list(ds.GetGeoTransform()),
+            'size': [ds.RasterXSize, ds.RasterYSize]}
+
+
+def scan_images(images, threads=1, cache=None, stamp=False, footprint=None):
+    """image_info() for each image, opened in a pool of threads
+
+    With `cache` (a JSON file), entries are kept by absolute path and only
+    images whose mtime or size has changed are opened again. The 'stamp'
+    (see image_stamp) is only looked up with `cache` or `stamp`, images
+    without one are always opened and never cached.
+
+    With `footprint` (image_footprint() keyword arguments) each entry also
+    gets its traced 'footprint', so cached images aren't traced again.
+    """
+    entries = {}
+    if cache is not None and os.path.exists(cache):
+        with open(cache) as f:
+            entries = json.load(f)
+
+    def scan(image):
+        key = image_location(image) if cache is not None else image
+        current = image_stamp(image) if cache is not None or stamp else None
+        entry = entries.get(key)
+        if current is None or entry is None or entry['stamp'] != current:
+            entry = {'stamp': current, **image_info(image)}
+        if footprint is not None:
+            options = [footprint.get('max_size', 1024), footprint.get('simplify'), footprint.get('buffer', 0)]
+            if entry.get('footprint', {}).get('options') != options:
+                entry = {**entry, 'footprint': {'options': options, 'wkt': image_footprint(image, *options)}}
+        return key, entry
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(scan, images))
+
+    if cache is not None:
+        entries.update((key, entry) for key, entry in results if entry['stamp'] is not None)
+        with open(cache + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(cache + '.tmp', cache)
+
+    return [entry for _, entry in results]
+
+
+# layer metadata item holding the options an index's geometries were made with
+OPTIONS_ITEM = "MW_EXTENT_OPTIONS"
+
+
+def create_vector(extents, srs, vector_file, format, layer_name, feature_names, locations=None, stamps=None,
+        update=False, geom_type=ogr.wkbPolygon, options=None):
+    """Create a polygon from a set of corner and write to an OGR vector file
+
+    `extents` may also be ogr.Geometry's (e.g. from GetFootprint) of `geom_type`.
+
+    With `locations` (and their `stamps`, see image_stamp) the file is a
+    tile index like gdaltindex's, with 'location', 'mtime' and 'size'
+    fields. With `update` an existing index is updated in place: features
+    of unchanged images are kept, changed ones replaced, new ones added
+    and those of image files that no longer exist removed. `options` (the
+    settings the geometries were made with) are stored in the layer's
+    metadata, an index made with different ones is rewritten from scratch.
+    """
+    options = json.dumps(options, sort_keys=True)
+    existing = {}
+    ds = None
+    if update and os.path.exists(vector_file):
+        ds = ogr.Open(vector_file, update=1)
+        lyr = ds.GetLayerByName(layer_name)
+        if lyr is None or lyr.GetMetadataItem(OPTIONS_ITEM) != options:
+            print(f"{vector_file}: made with other options, rewriting it")
+            drv = ds.GetDriver()
+            ds = None
+            drv.DeleteDataSource(vector_file)
+        else:
+            for feat in lyr:
+                existing[feat.GetField("location")] = (feat.GetFID(), [feat.GetField("mtime"), feat.GetField("size")])
+    if ds is None:
+        drv = ogr.GetDriverByName(format)
+        ds = drv.CreateDataSource(vector_file)
+        lyr = ds.CreateLayer(layer_name, srs, geom_type)
+
+        field_defn = ogr.FieldDefn("Name", ogr.OFTString)
+        lyr.CreateField(field_defn)
+        if locations is not None:
+            lyr.CreateField(ogr.FieldDefn("location", ogr.OFTString))
+            lyr.CreateField(ogr.FieldDefn("mtime", ogr.OFTReal))
+            lyr.CreateField(ogr.FieldDefn("size", ogr.OFTInteger64))
+        lyr.SetMetadataItem(OPTIONS_ITEM, options)
+
+    # one transaction rather than one per feature (GPKG/SQLite)
+    lyr.StartTransaction()
+    written = 0
+    # images that have been deleted (names that aren't files can't be checked)
+    removed = 0
+    for location in existing.keys() - set(locations or []):
+        if os.path.isabs(location) and gdal.VSIStatL(location) is None:
+            lyr.DeleteFeature(existing[location][0])
+            removed += 1
     for i, corners in enumerate(extents):
+        if locations is not None and locations[i] in existing:
+            fid, stamp = existing[locations[i]]
+            if stamps[i] is not None and stamp == list(stamps[i]):
+                continue
+            lyr.DeleteFeature(fid)
+
         feat = ogr.Feature(lyr.GetLayerDefn())
         feat.SetField("Name", feature_names[i])
+        if locations is not None:
+            feat.SetField("location", locations[i])
+            if stamps[i] is not None:
+                feat.SetField("mtime", stamps[i][0])
+                feat.SetField("size", stamps[i][1])
+
+        if isinstance(corners, ogr.Geometry):
+            poly = corners
+        else:
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in corners:
+                ring.AddPoint(x, y)
+            ring.AddPoint(corners[0][0], corners[0][1])
 
-        ring = ogr.Geometry(ogr.wkbLinearRing)
-        ring.AddPoint(corners[0][0], corners[0][1])
-        ring.AddPoint(corners[1][0], corners[1][1])
-        ring.AddPoint(corners[2][0], corners[2][1])
-        ring.AddPoint(corners[3][0], corners[3][1])
-        ring.AddPoint(corners[0][0], corners[0][1])
-
-        # Create polygon
-        poly = ogr.Geometry(ogr.wkbPolygon)
-        poly.AddGeometry(ring)
+            # Create polygon
+            poly = ogr.Geometry(ogr.wkbPolygon)
+            poly.AddGeometry(ring)
 
         feat.SetGeometry(poly)
         lyr.CreateFeature(feat)
         feat.Destroy()
+        written += 1
+    lyr.CommitTransaction()
 
+    if update:
+        print(f"{vector_file}: {written} features written, {len(extents) - written} unchanged, {removed} removed")
     ds.Destroy()
 
 if __name__ == "__main__":
@@ -126,17 +360,41 @@ if __name__ == "__main__":
     parser.add_argument("--epsg", type=int, default=None, help="EPSG code for output [default: same as input]")
     parser.add_argument("-tap", action='store_true', help="Target align pixels (make sure extent snaps to pixel size of raster)")
     parser.add_argument("--tap_size", type=float, help="Pixel size to use for -tap")
+    parser.add_argument("--densify", type=int, default=0, help="Add this many points along each edge before reprojecting (--epsg), so the output polygon and bounds follow the curved edges")
+    parser.add_argument("--footprint", action='store_true', help="Trace the outline of the valid (not nodata/masked) pixels instead of the whole extent, e.g. to skip scenes that are mostly nodata collar")
+    parser.add_argument("--footprint-size", type=int, default=1024, help="Trace --footprint from the mask at most this many pixels across (uses the coarsest overview that fits)")
+    parser.add_argument("--simplify", type=float, default=None, help="Simplify --footprint outlines to this tolerance (input CRS units) [default: the traced pixel size]")
+    parser.add_argument("--threads", type=int, default=8, help="Number of threads to read image metadata with")
+    parser.add_argument("--cache", default=None, help="JSON file caching image metadata (and --footprint outlines) by path, mtime and size, so reruns only open new/changed images")
+    parser.add_argument("--update", action='store_true', help="Update an existing --output tile index (e.g. GPKG, which is spatially indexed) in place: only new/changed images are (re)written and deleted ones removed, all of it if the geometry options have changed (add --cache so unchanged images aren't re-traced for --footprint either)")
     args = parser.parse_args()
 
+    footprint = dict(max_size=args.footprint_size, simplify=args.simplify, buffer=args.buffer) if args.footprint else None
+    infos = scan_images(args.images, threads=args.threads, cache=args.cache, stamp=args.update, footprint=footprint)
+
     #NOTE: corners format is [ul ur lr ll] OR [(xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)]
-    extents, srs = GetExtent(args.images, buffer=args.buffer, tap=args.tap, epsg=args.epsg, tap_size=args.tap_size)
+    extents, srs = GetExtent(args.images, buffer=args.buffer, tap=args.tap, epsg=args.epsg, tap_size=args.tap_size, infos=infos, densify=args.densify)
+    if args.footprint:
+        extents, srs = GetFootprint(args.images, infos, epsg=args.epsg, threads=args.threads,
+            max_size=args.footprint_size, simplify=args.simplify, buffer=args.buffer)
 
     if args.output is not None:
-        create_vector(extents, srs, args.output, args.of, "mw-extent", [image.split('/')[-1] for image in args.images])
+        create_vector(extents, srs, args.output, args.of, "mw-extent", [image.split('/')[-1] for image in args.images],
+            locations=[image_location(image) for image in args.images],
+            stamps=[info['stamp'] for info in infos], update=args.update,
+            geom_type=ogr.wkbMultiPolygon if args.footprint else ogr.wkbPolygon,
+            options={name: getattr(args, name) for name in ('buffer', 'epsg', 'tap', 'tap_size', 'densify',
+                'footprint', 'footprint_size', 'simplify')})
 
     for ext in extents:
+        if isinstance(ext, ogr.Geometry):
+            # an image with no valid pixels has no bounds
+            xmin, xmax, ymin, ymax = ext.GetEnvelope() if not ext.IsEmpty() else [math.nan] * 4
+        else:
+            # bounds of all points, the corners alone once reprojected/densified
+            (xmin, ymin), (xmax, ymax) = np.min(ext, axis=0), np.max(ext, axis=0)
         if args.ullr:
-            print(f"{ext[0][0]} {ext[0][1]} {ext[2][0]} {ext[2][1]}")
+            print(f"{xmin} {ymax} {xmax} {ymin}")
         else:
-            print(f"{ext[3][0]} {ext[3][1]} {ext[1][0]} {ext[1][1]}")
+            print(f"{xmin} {ymin} {xmax} {ymax}")
 
@@ -5,17 +5,36 @@ Usage:
     mw-gcptransform.py my.tif 3031
     OR
     mw-gcptransform.py my.tif 3031 --output my_transformed.tif
+    OR (many rasters, in 8 worker processes)
+    mw-gcptransform.py swaths/*.tif 3031 --workers 8
+    mw-gcptransform.py --file-list swaths.txt 3031 --workers 8
 """
 # Author: Ben Jolly
 
 import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
 from osgeo import gdal, osr
 import argparse
 
-def transform_GCP(gcp, transform):
-    """ Create a transformed copy of a osgeo.gdal.GCP"""
-    x, y, z = transform.TransformPoint(gcp.GCPY, gcp.GCPX, gcp.GCPZ)
-    return gdal.GCP(x, y, z, gcp.GCPPixel, gcp.GCPLine)
+# (source, target) SRS WKT -> osr.CoordinateTransformation, reused across rasters
+_transforms = {}
+
+def transform_GCPs(gcps, transform):
+    """ Create transformed copies of a list of osgeo.gdal.GCP with one TransformPoints call"""
+    points = np.array([(gcp.GCPY, gcp.GCPX, gcp.GCPZ) for gcp in gcps], dtype=float)
+    transformed = transform.TransformPoints(points)
+    return [gdal.GCP(x, y, z, gcp.GCPPixel, gcp.GCPLine) for (x, y, z), gcp in zip(transformed, gcps)]
+
+def get_transform(src_srs, tgt_srs):
+    """Cached osr.CoordinateTransformation for each pair of SRS"""
+    key = (src_srs.ExportToWkt(), tgt_srs.ExportToWkt())
+    if key not in _transforms:
+        _transforms[key] = osr.CoordinateTransformation(src_srs, tgt_srs)
+    return _transforms[key]
 
 def str_to_SRS(srs_str):
     """Convert a Proj4 or WKT string, or EPSG code, into an osgeo.osr.SpatialReference """
@@ -26,7 +45,7 @@ def str_to_SRS(srs_str):
     elif 'epsg' in srs_str.lower() or len(srs_str) == 4:
         srs.ImportFromEPSG(int(srs_str.strip()[-4:]))
     else:
-        srs.ImportFromWKT(srs_str)
+        srs.ImportFromWkt(srs_str)
 
     return srs
 
@@ -43,22 +62,54 @@ def transform_all_GCPs(raster, tgt_srs):
         if src_srs.IsSame(tgt_srs) == 1:
             print("WARNING: New SRS is the same as the current GCP SRS, skipping:", raster)
         else:
-            transform = osr.CoordinateTransformation(src_srs, tgt_srs)
-            transformed_GCPs = [transform_GCP(gcp, transform) for gcp in original_GCPs]
+            transformed_GCPs = transform_GCPs(original_GCPs, get_transform(src_srs, tgt_srs))
             ds.SetGCPs(transformed_GCPs, tgt_srs)
             print("Transformed GCPs in", raster)
 
     del ds
 
+@lru_cache(maxsize=None)
+def target_SRS(srs_str):
+    """str_to_SRS, parsed once per (worker) process"""
+    return str_to_SRS(srs_str)
+
+def transform_raster(raster, srs_str):
+    """transform_all_GCPs for a worker process, returns False (after printing why) if it failed"""
+    try:
+        transform_all_GCPs(raster, target_SRS(srs_str))
+        return True
+    except Exception as e:
+        print("ERROR: Failed to transform GCPs in", raster, ":", e)
+        return False
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Transform all GCPS in a raster to a different SRS (ie EPSG 4326 -> EPSG 3031)")
-    parser.add_argument('raster')
+    parser.add_argument('rasters', nargs='*', help="Raster(s) to transform the GCPs of")
     parser.add_argument('t_srs', help="Target SRS (EPSG code, PROJ4 string, or WKT)")
-    parser.add_argument('--output', default=None, help="Copy raster and modify this one instead")
+    parser.add_argument('--file-list', default=None, help="Text file of rasters (one per line) to transform, as well as any given as arguments")
+    parser.add_argument('--output', default=None, help="Copy raster and modify this one instead (single raster only)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes to transform rasters in")
     args = parser.parse_args()
 
+    rasters = list(args.rasters)
+    if args.file_list is not None:
+        with open(args.file_list) as f:
+            rasters += [line.strip() for line in f if line.strip()]
+    assert len(rasters) > 0, "No rasters given"
+
     if args.output is not None:
-        shutil.copyfile(args.raster, args.output)
-        args.raster = args.output
+        assert len(rasters) == 1, "--output only works with a single raster"
+        shutil.copyfile(rasters[0], args.output)
+        rasters = [args.output]
+
+    if args.workers > 1:
+        # each worker sets up GDAL/PROJ and the transformations once for many rasters
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(transform_raster, rasters, repeat(args.t_srs),
+                chunksize=max(1, len(rasters) // (args.workers * 4))))
+    else:
+        results = [transform_raster(raster, args.t_srs) for raster in rasters]
 
-    transform_all_GCPs(args.raster, str_to_SRS(args.t_srs))
\ No newline at end of file
+    if not all(results):
+        print(f"{results.count(False)} of {len(rasters)} rasters failed")
+        sys.exit(1)
\ No newline at end of file
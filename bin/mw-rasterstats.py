@@ -4,12 +4,24 @@
 # Author: Jan Schindler
 
 import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import islice
+from pathlib import Path
 
 from tqdm import tqdm
 
 import numpy as np
-from scipy import stats
+import pandas as pd
 import geopandas as gpd
+from shapely import STRtree, box
 
 import rasterio as rio
 from rasterio import features
@@ -17,63 +29,516 @@ from rasterio.transform import from_origin
 from rasterio import windows
 
 
-def np_stats(data: np.ndarray, metric: str) -> np.ndarray:
+class Profiler:
+    """Cumulative timings, bytes read and pixel counts per processing phase
+
+    Does nothing unless `enabled` (--profile). Phases are timed with
+    `with profiler.phase(name):`, per-feature totals with feature(). Timings
+    from reader threads are summed, so phase totals can exceed wall time.
+    """
+
+    PHASES = ['buffer', 'mask', 'read', 'nan_mask', 'stats']
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(list)
+        self.bytes = defaultdict(int)
+        self.pixels = defaultdict(int)
+        self.features = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name].append(time.perf_counter() - start)
+
+    def phase(self, name):
+        return self._phase(name) if self.enabled else nullcontext()
+
+    def count(self, name, nbytes=0, pixels=0):
+        if self.enabled:
+            with self.lock:
+                self.bytes[name] += int(nbytes)
+                self.pixels[name] += int(pixels)
+
+    def feature(self, feature, seconds, pixels):
+        if self.enabled:
+            # labels from gdf.iloc[] (in worker chunks) are NumPy scalars
+            feature = feature.item() if isinstance(feature, np.generic) else feature
+            self.features.append((feature, seconds, int(pixels)))
+
+    def state(self):
+        return dict(self.times), dict(self.bytes), dict(self.pixels), self.features
+
+    def merge(self, state):
+        """Add the state() of another Profiler, e.g. from a worker process"""
+        times, nbytes, pixels, feature_times = state
+        for name, values in times.items():
+            self.times[name].extend(values)
+        for name, value in nbytes.items():
+            self.bytes[name] += value
+        for name, value in pixels.items():
+            self.pixels[name] += value
+        self.features.extend(feature_times)
+
+    def report(self, path, slowest=20):
+        def summary(values):
+            values = np.asarray(values)
+            if values.size == 0:
+                return {'calls': 0, 'total_s': 0.}
+            return {
+                'calls': int(values.size), 'total_s': float(values.sum()), 'mean_s': float(values.mean()),
+                **{f'p{p}_s': float(np.percentile(values, p)) for p in [50, 90, 99]},
+                'max_s': float(values.max()),
+            }
+
+        phases = {}
+        for name in self.PHASES + sorted(set(self.times) - set(self.PHASES)):
+            if name in self.times or name in self.bytes:
+                phases[name] = {**summary(self.times.get(name, [])),
+                    'bytes': self.bytes.get(name, 0), 'pixels': self.pixels.get(name, 0)}
+
+        features = sorted(self.features, key=lambda f: f[1], reverse=True)
+        report = {
+            'wall_s': time.perf_counter() - self.start,
+            'phases': phases,
+            'features': summary([f[1] for f in self.features]),
+            'slowest_features': [{'feature': f, 'seconds': t, 'pixels': n} for f, t, n in features[:slowest]],
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+        print(f'Profile written to {path}')
+        for name, phase in phases.items():
+            print(f"  {name:>8}: {phase['total_s']:10.3f} s  {phase['calls']:8d} calls  {phase['bytes'] / 1024 ** 2:10.1f} MB")
+
+
+profiler = Profiler()
+
+
+# metrics that can be built from per-block partial sums, everything else
+# (median, percNN, mode...) needs all of a zone's pixels at once
+MOMENT_METRICS = ['mean', 'std', 'var', 'sum', 'max', 'min', 'count']
+
+
+# metrics for class rasters, along with classN (pixel count of class N)
+# and fracN (fraction of the zone's pixels in class N)
+CLASS_METRICS = ['mode', 'modefrac', 'minority', 'variety']
+
+
+def is_class_metric(metric):
+    return metric in CLASS_METRICS or re.fullmatch(r'(class|frac)-?\d+', metric) is not None
+
+
+def class_counts(values):
+    """(classes, counts) of a 1D array, by bincount for integers with a small range"""
+    if values.size == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    if np.issubdtype(values.dtype, np.integer):
+        vmin = int(values.min())
+        if int(values.max()) - vmin < 1_000_000:
+            counts = np.bincount((values - vmin).astype(np.int64))
+            classes = np.flatnonzero(counts)
+            return classes + vmin, counts[classes]
+    return np.unique(values, return_counts=True)
+
+
+def class_stats(classes, counts, metrics):
+    """Class metrics (in metrics' order) from a zone's class histogram"""
+    total = counts.sum()
     results = []
+    for metric in metrics:
+        if metric == 'variety':
+            result = len(classes)
+        elif metric.startswith('class'):
+            result = counts[classes == int(metric.replace('class', ''))].sum()
+        elif total == 0:
+            result = np.nan
+        elif metric == 'mode':
+            result = classes[np.argmax(counts)]
+        elif metric == 'modefrac':
+            result = counts.max() / total
+        elif metric == 'minority':
+            result = classes[np.argmin(counts)]
+        else:
+            result = counts[classes == int(metric.replace('frac', ''))].sum() / total
+        results.append(result)
+    return np.array(results, dtype=np.float64)
+
+
+def metric_dtype(metric):
+    """Column dtype for a metric, pixel counts are integers"""
+    if metric in ['count', 'variety'] or re.fullmatch(r'class-?\d+', metric):
+        return np.int64
+    return np.float64
+
+
+def metric_quantile(metric):
+    """Quantile (0-1) for an order statistic metric (median, percNN, quantQ), else None"""
+    if metric == 'median':
+        return 0.5
+    elif metric.startswith('perc'):
+        return int(metric.replace('perc', '')) / 100
+    elif metric.startswith('quant'):
+        return float(metric.replace('quant', ''))
+    return None
+
+
+def nan_quantiles(data, valid, quantiles):
+    """Linear-interpolated quantiles (as np.nanquantile) of each row of data
+
+    All requested quantiles come from a single np.partition per row.
+    """
+    results = np.full((len(quantiles), data.shape[0]), np.nan)
+    quantiles = np.asarray(quantiles)
+    for b in range(data.shape[0]):
+        values = data[b][valid[b]]
+        if values.size == 0:
+            continue
+        h = (values.size - 1) * quantiles
+        lo = np.floor(h).astype(int)
+        hi = np.minimum(lo + 1, values.size - 1)
+        values = np.partition(values, np.unique(np.r_[lo, hi])).astype(np.float64)
+        results[:, b] = values[lo] + (h - lo) * (values[hi] - values[lo])
+    return results
+
+
+class QuantileSketch:
+    """Mergeable, bounded-size approximate quantile sketch
+
+    Holds at most `size` weighted points. When full, the points are
+    replaced by `size // 2` evenly spaced (by weight) quantiles of
+    themselves, so memory is fixed however many values are added.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = np.zeros(0)
+        self.weights = np.zeros(0)
+
+    def _add(self, values, weights):
+        self.values = np.concatenate([self.values, values])
+        self.weights = np.concatenate([self.weights, weights])
+        if len(self.values) > self.size:
+            order = np.argsort(self.values, kind='stable')
+            values, weights = self.values[order], self.weights[order]
+            total = weights.sum()
+            keep = self.size // 2
+            positions = (np.arange(keep) + 0.5) * total / keep
+            self.values = np.interp(positions, np.cumsum(weights) - weights / 2, values)
+            self.weights = np.full(keep, total / keep)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self._add(values, np.ones(len(values)))
+
+    def merge(self, other):
+        self._add(other.values, other.weights)
+
+    def quantiles(self, quantiles):
+        if len(self.values) == 0:
+            return np.full(len(quantiles), np.nan)
+        order = np.argsort(self.values, kind='stable')
+        values, weights = self.values[order], self.weights[order]
+        total = weights.sum()
+        # mid-ranks, as the points were placed when compacting; as
+        # np.quantile's linear method when all weights are 1
+        positions = np.cumsum(weights) - weights / 2
+        return np.interp(np.asarray(quantiles) * (total - 1) + 0.5, positions, values)
+
+
+def np_stats(data: np.ndarray, metric: str, native: np.ndarray = None) -> np.ndarray:
+    """All metrics for each band of data ([band,] pixels...), NaNs are ignored
+
+    Moments come from one set of reductions shared by every metric and
+    all order statistics from a single partition per band. Class metrics
+    use bincounts of `native` (the data in its original, e.g. integer,
+    dtype) where given.
+    """
     if data.ndim == 1:
-        axis = 0
-    elif data.ndim == 2:
-        axis = 1
+        data = data[np.newaxis]
     elif data.ndim == 3:
-        axis = (1, 2)
+        data = data.reshape(data.shape[0], -1)
+    if native is None:
+        native = data
+    else:
+        native = native.reshape(data.shape)
+
+    valid = ~np.isnan(data)
+    count = valid.sum(axis=1)
+    moments = {'count': count}
+    if any(m in MOMENT_METRICS for m in metric):
+        filled = np.where(valid, data, 0).astype(np.float64)
+        total = filled.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            var = np.clip((filled * filled).sum(axis=1) / count - mean ** 2, 0, None)
+        moments.update({
+            'sum': total, 'mean': mean, 'var': var, 'std': np.sqrt(var),
+            'min': np.fmin.reduce(data, axis=1), 'max': np.fmax.reduce(data, axis=1),
+        })
 
+    quantiles = [q for q in map(metric_quantile, metric) if q is not None]
+    if quantiles:
+        quantile_results = dict(zip(quantiles, nan_quantiles(data, valid, quantiles)))
+
+    class_metrics = [m for m in metric if is_class_metric(m)]
+    if class_metrics:
+        class_results = np.stack([class_stats(*class_counts(native[b][valid[b]]), class_metrics)
+            for b in range(data.shape[0])], axis=1)
+
+    results = []
     for metric in metric:
-        if metric in ['mean', 'std', 'median', 'var', 'sum', 'max', 'min']:
-            result = getattr(np, f'nan{metric}')(data, axis=axis)
-        elif 'mode' in metric:
-            result = stats.mode(data.ravel())[0]
-        elif 'perc' in metric:
-            result = np.nanpercentile(data, int(metric.replace('perc', '')), axis=axis)
-        elif 'quant' in metric:
-            result = np.nanquantile(data, int(metric.replace('perc', '')), axis=axis)
-        elif metric == 'count':
-            result = (~np.isnan(data)).sum(axis=axis)
+        if metric in moments:
+            result = moments[metric]
+        elif is_class_metric(metric):
+            result = class_results[class_metrics.index(metric)]
+        elif metric_quantile(metric) is not None:
+            result = quantile_results[metric_quantile(metric)]
         else:
             raise Exception(f'Metric {metric} not defined.')
-        results.append(result)
-        #print(result.shape)
+        results.append(np.atleast_1d(result))
     return np.concatenate(results)
 
 
 
-def calc_stats(rio_image, df_row, bands, metrics, buffer, ignore):
-    geom = df_row.geometry
+def zone_mask(rio_image, geom, buffer, max_pixels=0):
+    """Pixel window and geometry mask (True outside the geometry) of geom on rio_image's grid
+
+    Only depends on the grid, so it can be reused for every image on the
+    same grid. Returns None for empty/invalid geometries. The mask is None
+    for windows of more than `max_pixels` pixels, these are left to
+    calc_stats_tiled.
+    """
     if buffer:
-        geom = geom.buffer(buffer)
-    
+        with profiler.phase('buffer'):
+            geom = geom.buffer(buffer)
+
     if np.isnan(geom.bounds).any():
         print('WARN: Empty/invalid geometry')
-        data = np.zeros((len(bands), 1, 1), dtype=float)
-        data[:] = np.nan
-    else:
-        res = rio_image.res[0]
-        xmin, ymin, xmax, ymax = geom.bounds
-        row_offset = np.floor((rio_image.bounds.top - ymax) / res).astype(int)
-        col_offset = np.floor((xmin - rio_image.bounds.left) / res).astype(int)
-        height = (np.ceil((rio_image.bounds.top - ymin) / res) - row_offset).astype(int)
-        width  = (np.ceil((xmax - rio_image.bounds.left) / res) - col_offset).astype(int)
+        return None
+
+    res = rio_image.res[0]
+    xmin, ymin, xmax, ymax = geom.bounds
+    row_offset = np.floor((rio_image.bounds.top - ymax) / res).astype(int)
+    col_offset = np.floor((xmin - rio_image.bounds.left) / res).astype(int)
+    height = (np.ceil((rio_image.bounds.top - ymin) / res) - row_offset).astype(int)
+    width  = (np.ceil((xmax - rio_image.bounds.left) / res) - col_offset).astype(int)
+
+    window = windows.Window(col_off=col_offset, row_off=row_offset, width=width, height=height)
+    if max_pixels and height * width > max_pixels:
+        return window, None
 
-        adj_ymax = rio_image.bounds.top - (res * np.floor((rio_image.bounds.top - ymax) / res))
-        adj_xmin = rio_image.bounds.left + (res * np.floor((xmin - rio_image.bounds.left) / res))        
+    adj_ymax = rio_image.bounds.top - (res * np.floor((rio_image.bounds.top - ymax) / res))
+    adj_xmin = rio_image.bounds.left + (res * np.floor((xmin - rio_image.bounds.left) / res))        
 
+    with profiler.phase('mask'):
         geom_mask = features.geometry_mask(
             geometries=[geom], out_shape=(height, width),
             transform=from_origin(adj_xmin, adj_ymax, res, res), all_touched=True
         )
+    profiler.count('mask', pixels=geom_mask.size)
+
+    return window, geom_mask
+
+
+def zone_max_pixels(rio_image, bands, zone_mem_mb):
+    """Largest window (in pixels) calc_stats may read at once within `zone_mem_mb`"""
+    if not zone_mem_mb:
+        return 0
+    # per band: native data, float32 copy, valid, and np_stats' float64
+    # filled and its square; plus one band's quantile partition (its
+    # valid values, the partitioned copy and that as float64) and the mask
+    itemsize = np.dtype(rio_image.dtypes[bands[0] - 1]).itemsize
+    pixel_bytes = len(bands) * (itemsize + 4 + 1 + 8 + 8) + (4 + 4 + 8) + 1
+    return max(1, int(zone_mem_mb * 1024 ** 2 / pixel_bytes))
+
+
+def calc_stats_tiled(rio_image, geom, window, bands, metrics, ignore, max_pixels, sketch=0):
+    """calc_stats for a zone whose window is too big to read at once
+
+    The window is read and masked in tiles of at most `max_pixels` pixels
+    and each tile is merged into a LabelAccumulator, so memory stays within
+    the budget. Moments and class metrics are exact, quantiles come from a
+    QuantileSketch.
+    """
+    if window.row_off < 0 or window.col_off < 0 or window.row_off + window.height > rio_image.height \
+            or window.col_off + window.width > rio_image.width:
+        print('WARN: Geometry mismatch, possibly partly outside image bounds!')
+        return np_stats(np.full((len(bands), 1, 1), np.nan), metrics)
+
+    res = rio_image.res[0]
+    zone_transform = from_origin(rio_image.bounds.left + res * window.col_off,
+        rio_image.bounds.top - res * window.row_off, res, res)
+    acc = LabelAccumulator(1, len(bands), metrics, sketch or 10000)
+
+    tile_width = min(window.width, max_pixels)
+    tile_height = max(1, max_pixels // tile_width)
+    for row in range(0, window.height, tile_height):
+        for col in range(0, window.width, tile_width):
+            tile = windows.Window(col, row, min(tile_width, window.width - col), min(tile_height, window.height - row))
+            with profiler.phase('mask'):
+                geom_mask = features.geometry_mask(
+                    geometries=[geom], out_shape=(tile.height, tile.width),
+                    transform=windows.transform(tile, zone_transform), all_touched=True
+                )
+            profiler.count('mask', pixels=geom_mask.size)
+            if geom_mask.all():
+                continue
+
+            with profiler.phase('read'):
+                native = rio_image.read(bands, window=windows.Window(window.col_off + col, window.row_off + row,
+                    tile.width, tile.height))
+            profiler.count('read', nbytes=native.nbytes, pixels=native.size)
+            with profiler.phase('nan_mask'):
+                data = native.astype(np.float32)
+                if rio_image.nodata is not None:
+                    data[data == rio_image.nodata] = np.nan
+                for val in ignore:
+                    data[data == val] = np.nan
+
+            inside = ~geom_mask
+            with profiler.phase('stats'):
+                acc.update(np.zeros(inside.sum(), dtype=np.int64), data[:, inside], native[:, inside])
+
+    with profiler.phase('stats'):
+        return acc.results()[0]
+
 
-        data = rio_image.read(window=windows.Window(col_off=col_offset, 
-            row_off=row_offset, width=geom_mask.shape[1], 
-            height=geom_mask.shape[0])).astype(np.float32)
-        data = data[np.array(bands) - 1]
+class ZoneIndex:
+    """zone_mask() of many features, stored as windows and flat pixel offsets
+
+    Offsets are the positions (in the flattened window) of the pixels inside
+    the geometry, in CSR layout (`indptr` gives each feature's slice).
+    Features with an empty/invalid geometry have `valid` False, features
+    too big to mask at once (see zone_mask) have `tiled` True.
+    """
+
+    def __init__(self, wins, valid, tiled, indptr, offsets):
+        self.wins = wins
+        self.valid = valid
+        self.tiled = tiled
+        self.indptr = indptr
+        self.offsets = offsets
+
+    @classmethod
+    def from_zones(cls, zones):
+        """ZoneIndex of a list of zone_mask() results"""
+        wins = np.zeros((len(zones), 4), dtype=np.int64)
+        valid = np.zeros(len(zones), dtype=bool)
+        tiled = np.zeros(len(zones), dtype=bool)
+        offsets = []
+        for i, zone in enumerate(zones):
+            if zone is None:
+                offsets.append(np.zeros(0, dtype=np.int64))
+                continue
+            window, geom_mask = zone
+            wins[i] = window.row_off, window.col_off, window.height, window.width
+            valid[i] = True
+            if geom_mask is None:
+                tiled[i] = True
+                offsets.append(np.zeros(0, dtype=np.int64))
+            else:
+                offsets.append(np.flatnonzero(~geom_mask.ravel()))
+        indptr = np.r_[0, np.cumsum([len(o) for o in offsets])].astype(np.int64)
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+        return cls(wins, valid, tiled, indptr,
+            offsets.astype(np.int32 if offsets.size == 0 or offsets.max() < 2 ** 31 else np.int64))
+
+    @classmethod
+    def concat(cls, parts):
+        """ZoneIndex of the rows of all `parts`, in order"""
+        if not parts:
+            return cls.from_zones([])
+        offsets = [part.offsets for part in parts]
+        lengths = np.concatenate([np.diff(part.indptr) for part in parts])
+        return cls(np.concatenate([part.wins for part in parts]), np.concatenate([part.valid for part in parts]),
+            np.concatenate([part.tiled for part in parts]), np.r_[0, np.cumsum(lengths)].astype(np.int64),
+            np.concatenate(offsets).astype(np.result_type(*offsets)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as cache:
+            return cls(cache['wins'], cache['valid'], cache['tiled'], cache['indptr'], cache['offsets'])
+
+    def save(self, path):
+        np.savez_compressed(path, wins=self.wins, valid=self.valid, tiled=self.tiled,
+            indptr=self.indptr, offsets=self.offsets)
+
+    def take(self, rows):
+        """ZoneIndex of just the given (positional) rows"""
+        rows = np.asarray(rows)
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        offsets = [self.offsets[self.indptr[i]:self.indptr[i + 1]] for i in rows]
+        return ZoneIndex(self.wins[rows], self.valid[rows], self.tiled[rows], np.r_[0, np.cumsum(lengths)].astype(np.int64),
+            np.concatenate(offsets) if len(offsets) else self.offsets[:0])
+
+    def zone(self, i):
+        """Same as zone_mask() for feature i"""
+        if not self.valid[i]:
+            return None
+        row_off, col_off, height, width = self.wins[i].tolist()
+        if self.tiled[i]:
+            return windows.Window(col_off, row_off, width, height), None
+        geom_mask = np.ones(height * width, dtype=bool)
+        geom_mask[self.offsets[self.indptr[i]:self.indptr[i + 1]]] = False
+        return windows.Window(col_off, row_off, width, height), geom_mask.reshape(height, width)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def zone_index_path(cache_dir, vector_hash, rio_image, nrows, buffer, start=0, max_pixels=0):
+    """Path of the cached ZoneIndex of `nrows` features from row `start` in `cache_dir`
+
+    Cache files are keyed by the vector file's hash, the image grid, the
+    buffer, all_touched and the range of rows, so any change to those
+    makes a new entry instead of reusing a stale one.
+    """
+    key = repr((vector_hash, tuple(rio_image.transform), rio_image.width, rio_image.height,
+        float(buffer), True, start, nrows, max_pixels))
+    return Path(cache_dir) / f"{hashlib.sha1(key.encode()).hexdigest()}.npz"
+
+
+def calc_stats(rio_image, df_row, bands, metrics, buffer, ignore, zone=False, max_pixels=0, sketch=0, native=None):
+    """Stats of one feature, `zone` is its zone_mask() if already known
+
+    `native` is the zone's window if it has already been read. Zones with
+    windows over `max_pixels` go through calc_stats_tiled.
+    """
+    if zone is False:
+        zone = zone_mask(rio_image, df_row.geometry, buffer, max_pixels)
+    if zone is not None and zone[1] is None:
+        geom = df_row.geometry
+        if buffer:
+            with profiler.phase('buffer'):
+                geom = geom.buffer(buffer)
+        return calc_stats_tiled(rio_image, geom, zone[0], bands, metrics, ignore, max_pixels, sketch)
+    
+    if zone is None:
+        native = None
+        data = np.zeros((len(bands), 1, 1), dtype=float)
+        data[:] = np.nan
+    else:
+        window, geom_mask = zone
+        if native is None:
+            with profiler.phase('read'):
+                native = rio_image.read(bands, window=window)
+            profiler.count('read', nbytes=native.nbytes, pixels=native.size)
+        data = native.astype(np.float32)
         
         if data.size == 0:
             print('WARN: Geometry outside image bounds!')
@@ -84,12 +549,17 @@ def calc_stats(rio_image, df_row, bands, metrics, buffer, ignore):
             data = np.zeros((len(bands), ) + geom_mask.shape, dtype=float)
             data[:] = np.nan
         else:
-            data[geom_mask & (data != rio_image.nodata)] = np.nan
+            with profiler.phase('nan_mask'):
+                data[:, geom_mask] = np.nan
+                if rio_image.nodata is not None:
+                    data[data == rio_image.nodata] = np.nan
 
-            for val in ignore:
-                data[data == val] = np.nan
+                for val in ignore:
+                    data[data == val] = np.nan
 
-    results = np_stats(data, metrics)
+    with profiler.phase('stats'):
+        results = np_stats(data, metrics, native if native is not None and native.shape == data.shape else None)
+    profiler.count('stats', pixels=data.size)
     
     # import matplotlib.pyplot as plt
     # _, ax = plt.subplots(nrows=1, ncols=2, sharex=True, sharey=True)
@@ -101,42 +571,736 @@ def calc_stats(rio_image, df_row, bands, metrics, buffer, ignore):
     return results
 
 
-def calculate_raster_stats(inputvector, raster, outputvector, metrics, prefix,
-        bands, bandnames, out_format, buffer, ignore):
-    gdf = gpd.read_file(inputvector)
-    rio_image = rio.open(raster, 'r')
+def spatial_order(geoms):
+    """Order of the geometries along a Hilbert curve, empty/missing geometries last"""
+    empty = (geoms.is_empty | geoms.isna()).to_numpy()
+    distance = np.full(len(geoms), np.iinfo(np.int64).max, dtype=np.int64)
+    if (~empty).any():
+        distance[~empty] = geoms[~empty].hilbert_distance()
+    return np.argsort(distance, kind='stable')
+
+
+class BlockCache:
+    """Serve window reads from an LRU cache of decoded raster blocks
+
+    Wraps an open rasterio dataset; anything other than read() is passed
+    through to it. Blocks are keyed by their (row, col) block index and
+    the least recently used ones are dropped once `max_bytes` is exceeded.
+    Windows are clipped to the image, as with a plain rasterio read.
+    """
+
+    def __init__(self, rio_image, max_bytes):
+        self.rio_image = rio_image
+        self.max_bytes = max_bytes
+        self.block_height, self.block_width = rio_image.block_shapes[0]
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self.rio_image, name)
+
+    def block(self, indexes, block_row, block_col):
+        key = (indexes, block_row, block_col)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        data = self.rio_image.read(list(indexes), window=windows.Window(
+            block_col * self.block_width, block_row * self.block_height,
+            min(self.block_width, self.rio_image.width - block_col * self.block_width),
+            min(self.block_height, self.rio_image.height - block_row * self.block_height)))
+        self.reads += 1
+        self.blocks[key] = data
+        self.nbytes += data.nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+        return data
+
+    def read(self, indexes, window):
+        indexes = tuple(indexes)
+        row_start, col_start = max(int(window.row_off), 0), max(int(window.col_off), 0)
+        row_stop = min(int(window.row_off + window.height), self.rio_image.height)
+        col_stop = min(int(window.col_off + window.width), self.rio_image.width)
+        out = np.zeros((len(indexes), max(row_stop - row_start, 0), max(col_stop - col_start, 0)),
+            dtype=self.rio_image.dtypes[indexes[0] - 1])
+        if out.size == 0:
+            return out
+
+        for block_row in range(row_start // self.block_height, (row_stop - 1) // self.block_height + 1):
+            for block_col in range(col_start // self.block_width, (col_stop - 1) // self.block_width + 1):
+                data = self.block(indexes, block_row, block_col)
+                top, left = block_row * self.block_height, block_col * self.block_width
+                r0, r1 = max(row_start, top), min(row_stop, top + data.shape[1])
+                c0, c1 = max(col_start, left), min(col_stop, left + data.shape[2])
+                out[:, r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    data[:, r0 - top:r1 - top, c0 - left:c1 - left]
+        return out
+
+
+def zone_windows(rio_image, geoms):
+    """Pixel window (row_off, col_off, height, width) of every geometry, as in calc_stats
+
+    Also returns a boolean array flagging the zones that are empty/invalid or
+    not fully inside the image (these get all-NaN data in calc_stats)
+    """
+    res = rio_image.res[0]
+    bounds = geoms.bounds.to_numpy() if len(geoms) else np.zeros((0, 4))
+    xmin, ymin, xmax, ymax = bounds.T
+    with np.errstate(invalid='ignore'):
+        row_off = np.floor((rio_image.bounds.top - ymax) / res)
+        col_off = np.floor((xmin - rio_image.bounds.left) / res)
+        height = np.ceil((rio_image.bounds.top - ymin) / res) - row_off
+        width = np.ceil((xmax - rio_image.bounds.left) / res) - col_off
+
+    wins = np.stack([row_off, col_off, height, width], axis=1)
+    bad = np.isnan(wins).any(axis=1)
+    wins[bad] = 0
+    wins = wins.astype(np.int64)
+    bad |= (wins[:, 2] <= 0) | (wins[:, 3] <= 0) | (wins[:, 0] < 0) | (wins[:, 1] < 0) \
+        | (wins[:, 0] + wins[:, 2] > rio_image.height) | (wins[:, 1] + wins[:, 3] > rio_image.width)
+
+    return wins, bad
+
+
+def zone_layers(wins):
+    """Split zones into layers whose pixel windows don't overlap
+
+    A label raster can only hold one zone per pixel, so overlapping (or
+    touching, with all_touched) polygons are rasterised in separate layers.
+    """
+    # shrink slightly so windows that only share an edge are not neighbours
+    boxes = box(wins[:, 1] + 0.1, wins[:, 0] + 0.1, wins[:, 1] + wins[:, 3] - 0.1, wins[:, 0] + wins[:, 2] - 0.1)
+    left, right = STRtree(boxes).query(boxes)
+    keep = left != right
+    left, right = left[keep], right[keep]
+    order = np.argsort(left, kind='stable')
+    left, right = left[order], right[order]
+    splits = np.searchsorted(left, np.arange(len(wins) + 1))
+
+    layers = np.full(len(wins), -1, dtype=np.int64)
+    for i in range(len(wins)):
+        taken = set(layers[right[splits[i]:splits[i + 1]]])
+        layer = 0
+        while layer in taken:
+            layer += 1
+        layers[i] = layer
+
+    return layers
+
+
+class LabelAccumulator:
+    """Per-zone, per-band partial statistics built up block by block"""
+
+    def __init__(self, nzones, nbands, metrics, sketch=0):
+        self.metrics = metrics
+        self.count = np.zeros((nzones, nbands), dtype=np.int64)
+        self.sum = np.zeros((nzones, nbands), dtype=np.float64)
+        self.sumsq = np.zeros((nzones, nbands), dtype=np.float64)
+        self.min = np.full((nzones, nbands), np.nan)
+        self.max = np.full((nzones, nbands), np.nan)
+        # with `sketch` set, quantiles come from fixed-size QuantileSketch's
+        # instead of keeping every pixel of the zone
+        self.sketch = sketch
+        self.sketches = {} if sketch and any(metric_quantile(m) is not None for m in metrics) else None
+        # class histograms, {(zone, band): {class: count}}
+        self.classes = {} if any(is_class_metric(m) for m in metrics) else None
+        # pixel values kept only for metrics that can't be merged
+        self.pixels = {} if any(m not in MOMENT_METRICS and not is_class_metric(m)
+            and not (sketch and metric_quantile(m) is not None) for m in metrics) else None
+
+    def update(self, zones, values, native=None):
+        """Add pixel `values` (band, pixel) belonging to `zones` (pixel,)
+
+        `native` is the same pixels in the image's own dtype, used for the
+        class histograms.
+        """
+        order = np.argsort(zones, kind='stable')
+        zones, values = zones[order], values[:, order]
+        starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+        uz = zones[starts]
+
+        nan = np.isnan(values)
+        filled = np.where(nan, 0, values).astype(np.float64)
+        self.count[uz] += np.add.reduceat(~nan, starts, axis=1).T
+        self.sum[uz] += np.add.reduceat(filled, starts, axis=1).T
+        self.sumsq[uz] += np.add.reduceat(filled * filled, starts, axis=1).T
+        self.min[uz] = np.fmin(self.min[uz], np.fmin.reduceat(values, starts, axis=1).T)
+        self.max[uz] = np.fmax(self.max[uz], np.fmax.reduceat(values, starts, axis=1).T)
+
+        if self.pixels is not None or self.sketches is not None:
+            for z, chunk in zip(uz, np.split(values, starts[1:], axis=1)):
+                if self.pixels is not None:
+                    self.pixels.setdefault(z, []).append(chunk)
+                if self.sketches is not None:
+                    if z not in self.sketches:
+                        self.sketches[z] = [QuantileSketch(self.sketch) for _ in range(len(chunk))]
+                    for sketch, band in zip(self.sketches[z], chunk):
+                        sketch.update(band)
+
+        if self.classes is not None:
+            native = values if native is None else native[:, order]
+            for b in range(len(values)):
+                ok = ~nan[b]
+                pairs, counts = np.unique(np.stack([zones[ok], native[b][ok]]), axis=1, return_counts=True)
+                for (z, value), n in zip(pairs.T.tolist(), counts.tolist()):
+                    histogram = self.classes.setdefault((int(z), b), {})
+                    histogram[value] = histogram.get(value, 0) + n
+
+    def results(self):
+        """Final (zone, metric * band) array, same layout as np_stats"""
+        nzones, nbands = self.count.shape
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / self.count
+            var = np.clip(self.sumsq / self.count - mean ** 2, 0, None)
+        merged = {
+            'count': self.count, 'sum': self.sum, 'mean': mean,
+            'var': var, 'std': np.sqrt(var), 'min': self.min, 'max': self.max,
+        }
+
+        if self.sketches is not None:
+            quantile_metrics = [m for m in self.metrics if metric_quantile(m) is not None]
+            quantiles = [metric_quantile(m) for m in quantile_metrics]
+            sketched = np.full((nzones, len(quantiles), nbands), np.nan)
+            for z, sketches in self.sketches.items():
+                for b, sketch in enumerate(sketches):
+                    sketched[z, :, b] = sketch.quantiles(quantiles)
+            for q, metric in enumerate(quantile_metrics):
+                merged[metric] = sketched[:, q]
+
+        class_metrics = [m for m in self.metrics if is_class_metric(m)]
+        if class_metrics:
+            classed = np.full((nzones, len(class_metrics), nbands), np.nan)
+            for z in range(nzones):
+                for b in range(nbands):
+                    histogram = self.classes.get((z, b), {})
+                    classed[z, :, b] = class_stats(np.array(list(histogram.keys())),
+                        np.array(list(histogram.values()), dtype=np.int64), class_metrics)
+            for i, metric in enumerate(class_metrics):
+                merged[metric] = classed[:, i]
+
+        others = [m for m in self.metrics if m not in merged]
+        if others:
+            other_results = np.full((nzones, len(others) * nbands), np.nan)
+            empty = np.full((nbands, 1), np.nan, dtype=np.float32)
+            for z in range(nzones):
+                chunks = self.pixels.get(z, [empty])
+                other_results[z] = np_stats(np.concatenate(chunks, axis=1), others)
+
+        results = []
+        for metric in self.metrics:
+            if metric in merged:
+                results.append(merged[metric])
+            else:
+                i = others.index(metric)
+                results.append(other_results[:, i * nbands:(i + 1) * nbands])
+        return np.concatenate(results, axis=1)
+
+
+def label_windows(rio_image, blocksize):
+    """Processing windows aligned to (multiples of) the image's native blocks"""
+    bh, bw = rio_image.block_shapes[0]
+    bh = max(1, int(np.ceil(blocksize / bh))) * bh
+    bw = max(1, int(np.ceil(blocksize / bw))) * bw
+    for row in range(0, rio_image.height, bh):
+        for col in range(0, rio_image.width, bw):
+            yield windows.Window(col, row, min(bw, rio_image.width - col), min(bh, rio_image.height - row))
+
+
+def calc_label_stats(rio_images, geoms, bands, metrics, ignore, blocksize=1024, sketch=0):
+    """Zonal stats for all geometries at once by rasterising zone IDs block by block
+
+    Gives the same results as running calc_stats over every geometry, but
+    each raster block is read once and reduced for all of its zones with
+    grouped (sort and split) operations. All `rio_images` must share a grid,
+    the label blocks are rasterised once and used for each of them.
+    """
+    rio_image = rio_images[0]
+    wins, bad = zone_windows(rio_image, geoms)
+    for i in np.flatnonzero(bad):
+        print(f'WARN: Empty/invalid geometry or outside image bounds (feature {geoms.index[i]})')
+
+    accs = [LabelAccumulator(len(geoms), len(bands), metrics, sketch) for _ in rio_images]
+    valid = np.flatnonzero(~bad)
+    if len(valid) == 0:
+        return np.concatenate([acc.results() for acc in accs], axis=1)
+
+    layers = np.full(len(geoms), -1, dtype=np.int64)
+    layers[valid] = zone_layers(wins[valid])
+
+    # zones are found by their pixel windows (rows/cols), not map coords
+    tree = STRtree(box(wins[valid, 1], wins[valid, 0], wins[valid, 1] + wins[valid, 3], wins[valid, 0] + wins[valid, 2]))
+    geom_values = geoms.values
+
+    blocks = list(label_windows(rio_image, blocksize))
+    for window in tqdm(blocks):
+        # shrunk so zones that only share an edge with this block are skipped
+        hits = valid[tree.query(box(window.col_off + 0.1, window.row_off + 0.1,
+            window.col_off + window.width - 0.1, window.row_off + window.height - 0.1))]
+        if len(hits) == 0:
+            continue
+
+        transform = windows.transform(window, rio_image.transform)
+        labels = []
+        for layer in np.unique(layers[hits]):
+            ids = hits[layers[hits] == layer]
+            with profiler.phase('mask'):
+                layer_labels = features.rasterize(
+                    zip(geom_values[ids], ids + 1), out_shape=(window.height, window.width),
+                    transform=transform, fill=0, all_touched=True, dtype='uint32'
+                )
+            profiler.count('mask', pixels=layer_labels.size)
+            inside = layer_labels > 0
+            if inside.any():
+                labels.append((inside, layer_labels[inside].astype(np.int64) - 1))
+
+        for image, acc in zip(rio_images, accs):
+            with profiler.phase('read'):
+                native = image.read(bands, window=window)
+            profiler.count('read', nbytes=native.nbytes, pixels=native.size)
+            with profiler.phase('nan_mask'):
+                data = native.astype(np.float32)
+                if image.nodata is not None:
+                    data[data == image.nodata] = np.nan
+                for val in ignore:
+                    data[data == val] = np.nan
+
+            with profiler.phase('stats'):
+                for inside, zones in labels:
+                    acc.update(zones, data[:, inside], native[:, inside])
+
+    with profiler.phase('stats'):
+        return np.concatenate([acc.results() for acc in accs], axis=1)
+
+
+def prefetch_zones(gdf, rows, bands, buffer, max_pixels, zones, open_images, prefetch, read_threads):
+    """Yield (zone, [window data per image]) for rows, read ahead in background threads
+
+    Up to `prefetch` features are masked and read ahead of the one being
+    used, by `read_threads` threads each with its own raster handles (from
+    open_images(), rasterio datasets can't be shared between threads).
+    Results come back in the order of `rows`. Window data is None for
+    zones calc_stats will not read directly (invalid or tiled).
+    """
+    local = threading.local()
+    handles = []
+
+    def load(i):
+        if not hasattr(local, 'images'):
+            local.images = open_images()
+            handles.extend(local.images)
+        zone = zone_mask(local.images[0], gdf.geometry.iloc[i], buffer, max_pixels) if zones is None else zones.zone(i)
+        if zone is None or zone[1] is None:
+            return zone, None
+        with profiler.phase('read'):
+            natives = [rio_image.read(bands, window=zone[0]) for rio_image in local.images]
+        profiler.count('read', nbytes=sum(n.nbytes for n in natives), pixels=sum(n.size for n in natives))
+        return zone, natives
+
+    try:
+        with ThreadPoolExecutor(max_workers=read_threads) as pool:
+            rows = iter(rows)
+            queue = deque(pool.submit(load, i) for i in islice(rows, prefetch))
+            while queue:
+                result = queue.popleft().result()
+                queue.extend(pool.submit(load, i) for i in islice(rows, 1))
+                yield result
+    finally:
+        for rio_image in handles:
+            rio_image.close()
+
+
+def calc_stats_rows(rio_images, gdf, rows, bands, metrics, buffer, ignore, ncols, progress=True, zones=None,
+        max_pixels=0, sketch=0, prefetch=0, read_threads=2, open_images=None, record=False):
+    """Run calc_stats over the given (positional) rows of gdf for each image
+
+    All images must share a grid, each feature's mask is built once (or
+    taken from the ZoneIndex `zones`) and used for all of them. With
+    `prefetch`, masks and windows are read ahead by prefetch_zones (using
+    handles from open_images()) while earlier features are reduced.
+    Returns a (row, image * column) array and, with `record`, the
+    ZoneIndex of the masks (in the order of rows). Per-feature times are
+    recorded in the profiler under gdf's index labels.
+    """
+    results = np.full((len(rows), len(rio_images) * ncols), np.nan)
+    if prefetch > 0:
+        loaded = prefetch_zones(gdf, rows, bands, buffer, max_pixels, zones, open_images, prefetch, read_threads)
+    else:
+        loaded = ((zone_mask(rio_images[0], gdf.geometry.iloc[i], buffer, max_pixels) if zones is None else zones.zone(i),
+            None) for i in rows)
+
+    recorded = []
+    for j, (i, (zone, natives)) in enumerate(zip(tqdm(rows, disable=not progress), loaded)):
+        if record:
+            recorded.append(zone)
+        start = time.perf_counter()
+        row = gdf.iloc[i]
+        natives = natives or [None] * len(rio_images)
+        results[j] = np.concatenate([calc_stats(rio_image, row, bands, metrics, buffer, ignore, zone, max_pixels, sketch,
+            native) for rio_image, native in zip(rio_images, natives)])
+        profiler.feature(gdf.index[i], time.perf_counter() - start,
+            0 if zone is None or zone[1] is None else zone[1].size)
+    if record:
+        return results, ZoneIndex.from_zones(recorded)
+    return results
+
+
+def open_rasters(rasters, levels=None):
+    return [open_raster(raster, level) for raster, level in zip(rasters, levels or [None] * len(rasters))]
+
+
+def calc_stats_chunk(rasters, gdf, bands, metrics, buffer, ignore, ncols, cache_mb, zones=None, max_pixels=0, sketch=0,
+        levels=None, prefetch=0, read_threads=2, profile=False, record=False):
+    """Worker process entry point: calc_stats over a chunk with its own raster handles
+
+    Returns the results, with `record` the chunk's ZoneIndex and with
+    `profile` the chunk's profiler state.
+    """
+    profiler.enabled = profile
+    profiler.reset()
+    rio_images = open_rasters(rasters, levels)
+    if cache_mb > 0:
+        rio_images = [BlockCache(rio_image, cache_mb * 1024 ** 2 / len(rasters)) for rio_image in rio_images]
+    try:
+        results = calc_stats_rows(rio_images, gdf, range(len(gdf)), bands, metrics, buffer, ignore, ncols,
+            progress=False, zones=zones, max_pixels=max_pixels, sketch=sketch, prefetch=prefetch,
+            read_threads=read_threads, open_images=partial(open_rasters, rasters, levels), record=record)
+        results, chunk_zones = results if record else (results, None)
+        return results, chunk_zones, profiler.state() if profile else None
+    finally:
+        for rio_image in rio_images:
+            rio_image.close()
+
+
+def calc_stats_parallel(rasters, gdf, rows, bands, metrics, buffer, ignore, ncols, cache_mb, workers, zones=None,
+        max_pixels=0, sketch=0, levels=None, prefetch=0, read_threads=2, record=False):
+    """Run calc_stats over contiguous chunks of `rows` in a pool of worker processes
+
+    `rows` should already be in spatial order so each chunk covers a compact
+    area. Results are returned in the order of `rows`, with `record`
+    together with the ZoneIndex the workers built (also in that order).
+    """
+    results = np.full((len(rows), len(rasters) * ncols), np.nan)
+    chunk_zones = {}
+    # a few chunks per worker so one dense area doesn't hold up the pool
+    chunks = [c for c in np.array_split(np.arange(len(rows)), workers * 4) if len(c)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(calc_stats_chunk, rasters, gdf.iloc[rows[chunk]], bands, metrics,
+                buffer, ignore, ncols, cache_mb, None if zones is None else zones.take(rows[chunk]),
+                max_pixels, sketch, levels, prefetch, read_threads, profiler.enabled, record): k
+            for k, chunk in enumerate(chunks)
+        }
+        with tqdm(total=len(rows)) as progress:
+            for future in as_completed(futures):
+                k = futures[future]
+                results[chunks[k]], chunk_zones[k], state = future.result()
+                if state is not None:
+                    profiler.merge(state)
+                progress.update(len(chunks[k]))
+    if record:
+        return results, ZoneIndex.concat([chunk_zones[k] for k in range(len(chunks))])
+    return results
+
+
+def zonal_stats(gdf, rasters, rio_images, bands, metrics, buffer, ignore, ncols,
+        engine='window', blocksize=1024, order='hilbert', cache_mb=256, workers=1, sketch=0, zones=None,
+        max_pixels=0, levels=None, prefetch=0, read_threads=2, record=False):
+    """Stats for every feature in gdf, as a (feature, image * column) array in gdf's order
+
+    All `rasters` (opened as `rio_images`, at overview `levels`) must share
+    a grid. `zones` is an optional precomputed ZoneIndex and `max_pixels`
+    the largest window to read at once (see calc_stats_tiled) for the
+    window engine. With `record` (window engine) the ZoneIndex of the
+    masks built along the way (e.g. to cache) is returned too, in gdf's
+    order: they are built where they are used, in the workers or prefetch
+    threads.
+    """
+    if engine == 'label':
+        geoms = gdf.geometry
+        if buffer:
+            with profiler.phase('buffer'):
+                geoms = geoms.buffer(buffer)
+        return calc_label_stats(rio_images, geoms, bands, metrics, ignore, blocksize, sketch)
+
+    # neighbouring features share raster blocks, so visit them together
+    if order == 'hilbert':
+        rows = spatial_order(gdf.geometry)
+    else:
+        rows = np.arange(len(gdf))
+
+    if workers > 1:
+        results = calc_stats_parallel(rasters, gdf, rows, bands, metrics, buffer, ignore,
+            ncols, cache_mb, workers, zones, max_pixels, sketch, levels, prefetch, read_threads, record)
+    else:
+        results = calc_stats_rows(rio_images, gdf, rows, bands, metrics, buffer, ignore, ncols, zones=zones,
+            max_pixels=max_pixels, sketch=sketch, prefetch=prefetch, read_threads=read_threads,
+            open_images=partial(open_rasters, rasters, levels), record=record)
+
+    if record:
+        results, zones = results
+        return results[np.argsort(rows)], zones.take(np.argsort(rows))
+    return results[np.argsort(rows)]
+
+
+def overview_level(raster, target_res):
+    """Coarsest overview level of raster with a resolution no coarser than target_res
+
+    None (full resolution) if even the first overview is too coarse.
+    """
+    with rio.open(raster, 'r') as rio_image:
+        factors = rio_image.overviews(1)
+        res = rio_image.res[0]
+    level = None
+    for i, factor in enumerate(factors):
+        if res * factor <= target_res:
+            level = i
+    return level
+
+
+def open_raster(raster, level=None):
+    """Open raster, at overview `level` (0 is the first overview) if given"""
+    if level is None:
+        return rio.open(raster, 'r')
+    return rio.open(raster, 'r', overview_level=level)
+
+
+class TableWriter:
+    """Write DataFrames batch by batch to one Parquet (.parquet) or Arrow IPC file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            if Path(self.path).suffix.lower() == '.parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def raster_names(rasters):
+    """Unique column prefix for each raster, its file name without extension
+
+    Rasters sharing a name (e.g. 2020-01/ndvi.kea, 2020-02/ndvi.kea) get
+    their parent directory's name too, or failing that their position.
+    """
+    names = [Path(raster).stem for raster in rasters]
+    if len(set(names)) < len(names):
+        names = [f"{Path(raster).parent.name}_{name}" if names.count(name) > 1 else name
+            for raster, name in zip(rasters, names)]
+    if len(set(names)) < len(names):
+        names = [f"{name}_{i}" if names.count(name) > 1 else name for i, name in enumerate(names)]
+    return names
+
+
+def grid_groups(rio_images):
+    """Indices of the images that share a grid (transform and size), grouped"""
+    groups = {}
+    for i, rio_image in enumerate(rio_images):
+        groups.setdefault((tuple(rio_image.transform), rio_image.width, rio_image.height), []).append(i)
+    return list(groups.values())
+
+
+def calculate_raster_stats(inputvector, rasters, outputvector, metrics, prefix,
+        bands, bandnames, out_format, buffer, ignore, engine='window', blocksize=1024,
+        order='hilbert', cache_mb=256, workers=1, batch_size=0, sketch=0, rasternames=None,
+        mask_cache=None, zone_mem_mb=0, overview=None, target_res=None, prefetch=0, read_threads=2,
+        stats_only=False, id_field=None, profile=None):
+    if isinstance(rasters, str):
+        rasters = [rasters]
+    if profile is not None:
+        profiler.enabled = True
+        profiler.reset()
+    # approximate stats from the rasters' pyramids, masks follow the overview grid
+    if target_res is not None:
+        levels = [overview_level(raster, target_res) for raster in rasters]
+    else:
+        levels = [overview] * len(rasters)
+    rio_images = open_rasters(rasters, levels)
+    if overview is not None or target_res is not None:
+        for raster, rio_image in zip(rasters, rio_images):
+            print(f'{raster}: using {rio_image.res[0]} resolution')
+    # shared by all batches when streaming
+    if engine == 'window' and workers == 1 and cache_mb > 0:
+        rio_images = [BlockCache(rio_image, cache_mb * 1024 ** 2 / len(rasters)) for rio_image in rio_images]
 
     
     column_names = [(f"{prefix[i]}_" if len(prefix[i]) > 0 else '') + b + ('_' if len(bandnames) > 0 else '') + stat for stat in metrics for i, b in enumerate(bandnames)]
     # calc_stats(rio_image, gdf.iloc[0], bands, stats)
+    options = dict(engine=engine, blocksize=blocksize, order=order, cache_mb=cache_mb, workers=workers,
+        sketch=sketch, prefetch=prefetch, read_threads=read_threads)
+
+    # one set of columns per raster, masks are shared by rasters on the same grid
+    if len(rasters) > 1:
+        if rasternames is None:
+            rasternames = raster_names(rasters)
+        assert len(set(rasternames)) == len(rasternames), "Raster names should be unique"
+        raster_columns = [[f"{name}_{c}" for c in column_names] for name in rasternames]
+        res_columns = [f"{name}_stats_res" for name in rasternames]
+    else:
+        raster_columns = [column_names]
+        res_columns = ['stats_res']
+    groups = grid_groups(rio_images)
+    vector_hash = file_hash(inputvector) if mask_cache is not None and engine == 'window' else None
 
-    for i, row in tqdm(gdf.iterrows(), total=len(gdf)):
-        gdf.loc[i, column_names] = calc_stats(rio_image, row, bands, metrics, buffer, ignore)
+    # count-like metrics stay integers instead of being upcast to float
+    column_dtypes = [metric_dtype(stat) for stat in metrics for _ in bandnames]
+
+    def feature_stats(gdf, start=0):
+        """DataFrame of all stats columns for gdf, built from typed arrays"""
+        columns = {}
+        for group in groups:
+            max_pixels = min(zone_max_pixels(rio_images[i], bands, zone_mem_mb) for i in group)
+            zones, path = None, None
+            if vector_hash is not None:
+                path = zone_index_path(mask_cache, vector_hash, rio_images[group[0]], len(gdf), buffer,
+                    start, max_pixels)
+                zones = ZoneIndex.load(path) if path.exists() else None
+            # a cold cache is filled with the masks built while calculating
+            record = path is not None and zones is None
+            results = zonal_stats(gdf, [rasters[i] for i in group], [rio_images[i] for i in group],
+                bands, metrics, buffer, ignore, len(column_names), zones=zones, max_pixels=max_pixels,
+                levels=[levels[i] for i in group], record=record, **options)
+            if record:
+                results, zones = results
+                path.parent.mkdir(parents=True, exist_ok=True)
+                zones.save(path)
+            for j, i in enumerate(group):
+                for k, (column, dtype) in enumerate(zip(raster_columns[i], column_dtypes)):
+                    columns[column] = results[:, j * len(column_names) + k].astype(dtype)
+        # resolution the stats were actually calculated at
+        if overview is not None or target_res is not None:
+            for i, column in enumerate(res_columns):
+                columns[column] = np.full(len(gdf), rio_images[i].res[0])
+        return pd.DataFrame(columns, index=gdf.index)
+
+    def read_features(rows=None):
+        # the table output doesn't need any attributes other than the ID
+        columns = ([id_field] if id_field else []) if stats_only else None
+        if not stats_only or id_field:
+            return gpd.read_file(inputvector, rows=rows, columns=columns)
+        # the input's own feature IDs (e.g. GPKG FIDs start at 1 and may have gaps)
+        gdf = gpd.read_file(inputvector, rows=rows, columns=columns, fid_as_index=True)
+        gdf['fid'] = gdf.index.to_numpy()
+        return gdf.reset_index(drop=True)
+
+    def write_features(gdf, stats, start, writer):
+        if stats_only:
+            ids = gdf[id_field or 'fid'].to_numpy()
+            writer.write(pd.concat([pd.DataFrame({id_field or 'fid': ids}, index=gdf.index), stats], axis=1))
+        else:
+            gdf = gdf.drop(columns=stats.columns, errors='ignore').join(stats)
+            gdf.to_file(outputvector, driver=out_format, mode='w' if start == 0 else 'a')
+
+    writer = TableWriter(outputvector) if stats_only else None
+    if batch_size > 0:
+        # read, process and append `batch_size` features at a time, each
+        # append is written in its own transaction so finished batches
+        # survive a crash and memory use doesn't grow with the layer size
+        start = 0
+        while True:
+            gdf = read_features(slice(start, start + batch_size))
+            if len(gdf) == 0 and start > 0:
+                break
+            # positions in the whole layer, for the profile report
+            gdf.index = pd.RangeIndex(start, start + len(gdf))
+            print(f'Features {start} - {start + len(gdf)}')
+            write_features(gdf, feature_stats(gdf, start), start, writer)
+            start += len(gdf)
+            if len(gdf) < batch_size:
+                break
+    else:
+        gdf = read_features()
+        write_features(gdf, feature_stats(gdf), 0, writer)
 
-    gdf.to_file(outputvector, driver=out_format)
+    if writer is not None:
+        writer.close()
+    if profile is not None:
+        profiler.report(profile)
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("inputvector", help="Vector source file name")
-    parser.add_argument("raster", help="Raster file name")
+    parser.add_argument("rasters", nargs='+',
+        help="Raster file name(s), with several rasters each gets its own set of columns " \
+             "(prefixed with --rasternames) and features are rasterised once per grid")
     parser.add_argument("outputvector", help="Output vector file name")
     parser.add_argument("--metrics", nargs='*', type=str, default=[''], 
         help="List of statistics to calculate, e.g., ['mean, std'] or " \
-             "['perc25', 'perc75'] for the 25th and 75th percentiles.")
+             "['perc25', 'perc75'] for the 25th and 75th percentiles. For class rasters: " \
+             "mode, modefrac (fraction of pixels in the mode class), minority, variety, " \
+             "classN / fracN (pixel count / fraction of class N).")
     parser.add_argument("--bands", nargs='*', type=int, default=[1], 
         help="Band number(s) to select")
     parser.add_argument("--prefix", type=str, default=[''], 
         help="Attribute prefix(s) for band(s)")
     parser.add_argument("--bandnames", nargs='*', type=str, default=[''], 
         help="Band names")
+    parser.add_argument("--rasternames", nargs='*', type=str, default=None,
+        help="Column prefix for each raster when using several rasters [default: file names]")
+    parser.add_argument("--mask-cache", type=str, default=None,
+        help="Directory to cache rasterised feature masks in (--engine window), reruns with the " \
+             "same vector file, grid and --buffer skip all geometry work")
+    parser.add_argument("--overview-level", type=int, default=None,
+        help="Calculate (approximate) stats from this overview level of the raster(s), 0 is the " \
+             "first overview (see mw-setbanddescr.py -p). Adds a 'stats_res' column")
+    parser.add_argument("--target-res", type=float, default=None,
+        help="Calculate (approximate) stats from the coarsest overview level no coarser than this " \
+             "resolution. Adds a 'stats_res' column")
+    parser.add_argument("--stats-only", action='store_true',
+        help="Write only the feature ID and stats columns (no geometry) to outputvector as a " \
+             "Parquet (.parquet) or Arrow IPC (.arrow/.feather) table, needs pyarrow")
+    parser.add_argument("--id-field", type=str, default=None,
+        help="Attribute to use as the feature ID with --stats-only [default: 'fid', the input's " \
+             "feature IDs]")
     parser.add_argument("--format", type=str, default='GPKG', 
         help="Output vector format")
     parser.add_argument("--buffer", type=float, default=0., 
         help="Buffer radius of vector features")
     parser.add_argument("--ignore", nargs='*', type=float, default=[0.], 
         help="Values to ignore during metric calculation")
+    parser.add_argument("--engine", choices=['window', 'label'], default='window',
+        help="'window' reads and masks a window per feature, 'label' rasterises all " \
+             "feature IDs block by block and reduces each block once (faster for many small features)")
+    parser.add_argument("--blocksize", type=int, default=1024,
+        help="Approximate processing block size (pixels) for --engine label")
+    parser.add_argument("--order", choices=['hilbert', 'input'], default='hilbert',
+        help="Order to visit features in with --engine window (output keeps the input order)")
+    parser.add_argument("--cache-mb", type=float, default=256,
+        help="Size of the raster block cache (MB) for --engine window, 0 to disable")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of worker processes for --engine window (features are split into spatially compact chunks)")
+    parser.add_argument("--prefetch", type=int, default=0,
+        help="With --engine window, read this many features ahead in background threads while " \
+             "earlier ones are reduced (overlaps I/O with compute), 0 to disable")
+    parser.add_argument("--read-threads", type=int, default=2,
+        help="Number of reader threads for --prefetch")
+    parser.add_argument("--batch-size", type=int, default=0,
+        help="Stream the input in batches of this many features, appending each to the output " \
+             "(keeps memory flat for very large layers, output format must support appending)")
+    parser.add_argument("--sketch", type=int, default=0,
+        help="With --engine label, estimate median/percNN/quantQ from a fixed-size sketch of " \
+             "this many points per zone and band instead of keeping every pixel (approximate). " \
+             "Also the sketch size for --zone-mem-mb [default there 10000]")
+    parser.add_argument("--profile", type=str, default=None,
+        help="Write a JSON report of time, bytes read and pixels per phase (buffer, mask, read, " \
+             "nan_mask, stats) and the slowest features to this file")
+    parser.add_argument("--zone-mem-mb", type=float, default=0,
+        help="With --engine window, read features whose window would need more memory than this " \
+             "in tiles and merge partial stats (quantiles become approximate), 0 to disable")
     args = parser.parse_args()
 
     if len(args.bands) > 1:
@@ -153,10 +1317,14 @@ if __name__ == "__main__":
         
     assert len(args.bandnames) == len(args.bands), "--bandnames should either be 1 arg or the same length as --bands"
     assert len(args.prefix) == len(args.bands), "--prefix should either be 1 arg or the same length as --bands"
+    assert args.rasternames is None or len(args.rasternames) == len(args.rasters), "--rasternames should be the same length as rasters"
+    assert args.rasternames is None or len(set(args.rasternames)) == len(args.rasternames), "--rasternames should be unique"
+    assert args.overview_level is None or args.target_res is None, "Use only one of --overview-level and --target-res"
+    assert args.workers == 1 or args.engine == 'window', "--workers is only supported with --engine window"
 
     calculate_raster_stats(
         args.inputvector, 
-        args.raster, 
+        args.rasters, 
         args.outputvector,
         metrics=args.metrics, 
         prefix=args.prefix, 
@@ -164,7 +1332,24 @@ if __name__ == "__main__":
         bandnames=args.bandnames, 
         out_format=args.format, 
         buffer=args.buffer,
-        ignore=args.ignore
+        ignore=args.ignore,
+        engine=args.engine,
+        blocksize=args.blocksize,
+        order=args.order,
+        cache_mb=args.cache_mb,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        sketch=args.sketch,
+        rasternames=args.rasternames,
+        mask_cache=args.mask_cache,
+        zone_mem_mb=args.zone_mem_mb,
+        overview=args.overview_level,
+        target_res=args.target_res,
+        prefetch=args.prefetch,
+        read_threads=args.read_threads,
+        stats_only=args.stats_only,
+        id_field=args.id_field,
+        profile=args.profile
     )
 
 # python rasterstats.py /nesi/project/landcare03178/data/experiments/trees-wairarapa/model_detectron2/prediction_gwrc_RGB_2021_wairarapa_2.gpkg /nesi/project/landcare03178/data/experiments/wairarapa-species/model_smp_unet64_f1_jaccard/prediction_gwrc_RGBI_2021_wairarapa_2.kea /nesi/project/landcare03178/data/experiments/trees-wairarapa/model_detectron2/prediction_gwrc_RGB_2021_wairarapa_2_species.gpkg --metrics mode --bands 1 --bandnames CLASS --buffer 0  
\ No newline at end of file
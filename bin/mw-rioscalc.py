@@ -6,41 +6,576 @@ Available libraries are:
 
 --calc should eval() to a 3D numpy array (band, x, y), inputs are available 
     from the 3D (1 image) or 4D (multiple images) ndarray 'rasters' ([image,] band, x, y)
+    and named inputs (--input name=file[:band,band...]) as 3D arrays (band, x, y).
+    Only inputs that --calc/--calcmask refer to are read and, of inputs they only
+    index with constants (rasters[0], img[2]), only those rasters/bands.
+    Blocks outside a --skipmask AOI are filled with nodata without evaluating the formula.
+
+--reduce replaces --calc with per-pixel statistics over 'rasters' (all on the same
+    grid), read --group-size rasters at a time into running accumulators so any
+    number of rasters fits in memory. Output bands are each statistic for each band.
+
+Formulas are compiled once. With --backend numexpr, elementwise ones (arithmetic,
+comparisons, & | ~, np.where/sqrt/log/exp/...) are evaluated with numexpr, anything
+else (e.g. reductions like np.nanmean) with NumPy.
 
 Usage:
     mw-rioscalc.py --calc "np.nanmean(rasters, axis=0)" result.kea /path/to/*.kea --bandnames band_a band_b
+    mw-rioscalc.py --calc "(nir - red) / (nir + red)" ndvi.kea --input red=a.kea:3 nir=a.kea:4
+    mw-rioscalc.py --reduce mean std median perc90 count lst_stats.kea /path/to/*.kea
+
+    # split across e.g. an array job, then mosaic the tiles with stats and pyramids
+    mw-rioscalc.py --partition $SLURM_ARRAY_TASK_ID/10 result.kea /path/to/*.kea
+    mw-rioscalc.py --merge 10 -of COG result.tif
 """
 import sys
 import argparse
+import ast
+import json
 import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import os
 import numpy as np
-from rios import applier, cuiprogress, fileinfo
+from osgeo import gdal
+from rios import applier, cuiprogress, fileinfo, pixelgrid
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 
 np.seterr(invalid='ignore')
 
 # lambdas
 getdate = lambda x: re.findall('_(\\d{6})_', x)[0]
+parse_nodata = lambda x: int(x) if '.' not in x else np.nan if x == "np.nan" else float(x)
+
+# functions numexpr can evaluate, called either bare or as np.<name>
+NUMEXPR_FUNCS = {
+    'where', 'sqrt', 'exp', 'expm1', 'log', 'log10', 'log1p', 'abs', 'floor', 'ceil',
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh',
+    'arcsinh', 'arccosh', 'arctanh',
+}
+NUMEXPR_OPS = (
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.BitAnd, ast.BitOr, ast.BitXor,
+    ast.USub, ast.UAdd, ast.Invert, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+
+def numexpr_source(source):
+    """Rewrite a formula for numexpr.evaluate()
+
+    Subscripts and attributes (rasters[0], np.nan) are hoisted out into
+    variables evaluated with NumPy first, as numexpr can't index. Returns
+    (expression, {variable: compiled NumPy expression}) or None if the
+    formula isn't purely elementwise.
+    """
+    leaves = {}
+
+    def hoist(node):
+        name = f"_v{len(leaves)}"
+        leaves[name] = compile(ast.Expression(node), '<calc>', 'eval')
+        return ast.Name(id=name, ctx=ast.Load())
+
+    def visit(node):
+        if isinstance(node, (ast.Subscript, ast.Attribute)):
+            return hoist(node)
+        if isinstance(node, ast.Name) or isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node
+        if isinstance(node, ast.BinOp) and isinstance(node.op, NUMEXPR_OPS):
+            return ast.BinOp(left=visit(node.left), op=node.op, right=visit(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, NUMEXPR_OPS):
+            return ast.UnaryOp(op=node.op, operand=visit(node.operand))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], NUMEXPR_OPS):
+            return ast.Compare(left=visit(node.left), ops=node.ops, comparators=[visit(node.comparators[0])])
+        if isinstance(node, ast.Call) and not node.keywords:
+            func = node.func
+            if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'np':
+                func = ast.Name(id=func.attr, ctx=ast.Load())
+            if isinstance(func, ast.Name) and func.id in NUMEXPR_FUNCS:
+                return ast.Call(func=func, args=[visit(arg) for arg in node.args], keywords=[])
+        raise ValueError(f"numexpr can't evaluate {ast.unparse(node)}")
+
+    try:
+        tree = visit(ast.parse(source, mode='eval').body)
+    except ValueError:
+        return None
+    # nothing left for numexpr to fuse
+    if isinstance(tree, ast.Name):
+        return None
+    return ast.unparse(tree), leaves
+
+
+def constant_indices(sources):
+    """{name: sorted indices} of the names the formulas only index with constants
+
+    e.g. 'rasters[0] - rasters[2]' gives {'rasters': [0, 2]}. Names also
+    used whole, sliced or with a computed (or negative) index are left out.
+    """
+    indices, whole = {}, set()
+    for source in sources:
+        tree = ast.parse(source, mode='eval')
+        indexed = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and is_constant_index(node.slice):
+                indexed.add(id(node.value))
+                indices.setdefault(node.value.id, set()).add(node.slice.value)
+        whole |= {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and id(node) not in indexed}
+    return {name: sorted(values) for name, values in indices.items() if name not in whole}
+
+
+def is_constant_index(node):
+    return isinstance(node, ast.Constant) and type(node.value) is int and node.value >= 0
+
+
+def reindex(source, positions):
+    """Rewrite constant indices of a formula, positions is {name: {old index: new index}}"""
+
+    class Reindex(ast.NodeTransformer):
+        def visit_Subscript(self, node):
+            node = self.generic_visit(node)
+            if isinstance(node.value, ast.Name) and node.value.id in positions and is_constant_index(node.slice):
+                node.slice = ast.Constant(positions[node.value.id][node.slice.value])
+            return node
+
+    return ast.unparse(Reindex().visit(ast.parse(source, mode='eval')))
+
+
+def first_pixel(value):
+    """The top left pixel of a block array, or of each array in a list (e.g. 'rasters')"""
+    return [v[..., :1, :1] for v in value] if isinstance(value, list) else value[..., :1, :1]
+
+
+class Expression:
+    """A --calc/--calcmask formula, compiled once and then evaluated per block
+
+    numexpr results are cast to the type NumPy would give (found from the
+    first pixel of the first block), so the backend doesn't change outputs.
+    """
+
+    def __init__(self, source, backend='numpy'):
+        self.source = source
+        self.dtype = None
+        self.code = compile(source, '<calc>', 'eval')
+        self.names = {node.id for node in ast.walk(ast.parse(source, mode='eval')) if isinstance(node, ast.Name)}
+        self.numexpr = numexpr_source(source) if backend != 'numpy' and ne is not None else None
+        if backend == 'numexpr' and self.numexpr is None:
+            print(f"WARN: using NumPy for '{source}'" + (" (numexpr not installed)" if ne is None else ""))
+
+    def __call__(self, **names):
+        names["np"] = np
+        if self.numexpr is None:
+            return eval(self.code, names)
+        expression, leaves = self.numexpr
+        local_dict = {name: eval(code, names) for name, code in leaves.items()}
+        local_dict.update(names)
+        result = ne.evaluate(expression, local_dict=local_dict)
+        if self.dtype is None:
+            # names also holds np and eval()'s __builtins__
+            sample = {name: first_pixel(value) if isinstance(value, (np.ndarray, list)) else value
+                for name, value in names.items()}
+            self.dtype = np.asarray(eval(self.code, sample)).dtype
+        return result.astype(self.dtype, copy=False)
+
+def parse_input(text):
+    """'name=file[:band,band...]' -> (name, file, [bands] or None for all bands)"""
+    name, _, path = text.partition('=')
+    if not name.isidentifier() or name in ('np', 'rasters', 'result') or not path:
+        raise argparse.ArgumentTypeError(f"expected name=file[:band,...] with a valid (not reserved) name, got '{text}'")
+    bands = None
+    if re.fullmatch(r'.+:\d+(,\d+)*', path):
+        path, _, bands = path.rpartition(':')
+        bands = [int(band) for band in bands.split(',')]
+    return name, path, bands
+
+def window_size(rasters, mem_budget, blocks_in_flight, max_size, step=256, extra_bytes=0):
+    """Largest square window (multiple of `step`) whose blocks fit in mem_budget bytes
+
+    `rasters` is a list of (file, [bands] or None for all bands). Counts
+    every band read at its own data type, plus a float64 working copy of
+    each for the formula's temporaries and `extra_bytes` per pixel (e.g.
+    --reduce accumulators), for each of the `blocks_in_flight` blocks
+    being read/computed/written at once.
+    """
+    bytes_per_pixel = extra_bytes
+    for raster, bands in rasters:
+        info = fileinfo.ImageInfo(raster)
+        nbands = info.rasterCount if bands is None else len(bands)
+        bytes_per_pixel += nbands * (gdal.GetDataTypeSize(info.dataType) // 8 + 8)
+    size = int(np.sqrt(mem_budget / (bytes_per_pixel * blocks_in_flight)))
+    return int(np.clip(size // step * step, step, max(step, max_size)))
+
+def block_validity(skipmask, ref, winxsize, winysize):
+    """Boolean (yblock, xblock) array, True for rios blocks with any part of the AOI
+
+    A raster skipmask (on the reference grid, pixels > 0 inside the AOI) is
+    averaged down to one pixel per block by GDAL, which uses its overviews
+    where it can. A vector skipmask is rasterised (all touched) straight
+    onto the block grid.
+    """
+    nxblocks = -(-ref.ncols // winxsize)
+    nyblocks = -(-ref.nrows // winysize)
+    ds = gdal.OpenEx(skipmask)
+    if ds is None:
+        raise Exception(f"Can't open --skipmask {skipmask}")
+
+    if ds.RasterCount == 0:
+        mem = gdal.GetDriverByName('MEM').Create('', nxblocks, nyblocks, 1, gdal.GDT_Byte)
+        x0, xres, _, y0, _, yres = ref.transform
+        mem.SetGeoTransform((x0, xres * winxsize, 0, y0, 0, yres * winysize))
+        mem.SetProjection(ref.projection)
+        gdal.Rasterize(mem, ds, burnValues=[1], allTouched=True)
+        return mem.ReadAsArray() > 0
+
+    assert (ds.RasterXSize, ds.RasterYSize) == (ref.ncols, ref.nrows), "--skipmask raster should be on the same grid as the input(s)"
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    valid = np.zeros((nyblocks, nxblocks), dtype=bool)
+    # whole blocks in one read, then the partial last column/row of blocks
+    nxfull, nyfull = ref.ncols // winxsize, ref.nrows // winysize
+    xparts = [(0, nxfull * winxsize, 0, nxfull), (nxfull * winxsize, ref.ncols - nxfull * winxsize, nxfull, nxblocks - nxfull)]
+    yparts = [(0, nyfull * winysize, 0, nyfull), (nyfull * winysize, ref.nrows - nyfull * winysize, nyfull, nyblocks - nyfull)]
+    for xoff, xsize, xblock, nx in xparts:
+        for yoff, ysize, yblock, ny in yparts:
+            if xsize == 0 or ysize == 0:
+                continue
+            mean = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=nx, buf_ysize=ny,
+                buf_type=gdal.GDT_Float32, resample_alg=gdal.GRIORA_Average)
+            valid[yblock:yblock + ny, xblock:xblock + nx] = (mean > 0) & (mean != nodata if nodata is not None else True)
+    return valid
+
+REDUCE_STATS = ['mean', 'std', 'var', 'sum', 'min', 'max', 'count']
+
+def stat_quantile(stat):
+    """Quantile (0-1) for median, percNN or quantQ, else None"""
+    if stat == 'median':
+        return 0.5
+    elif re.fullmatch(r'perc\d+(\.\d+)?', stat):
+        return float(stat[4:]) / 100
+    elif re.fullmatch(r'quant[\d.]+', stat):
+        return float(stat[5:])
+    return None
+
+def interp_rows(x, xp, fp):
+    """np.interp of each row of x over the same row of xp, fp
+
+    Rows of xp are ascending with NaNs (no points) at the end, rows with
+    no points give NaN. One searchsorted over the whole array, with each
+    row offset past the previous one.
+    """
+    nvalid = (~np.isnan(xp)).sum(axis=1, keepdims=True)
+    rowmax = np.where(nvalid > 0, np.nanmax(np.where(np.isnan(xp), -np.inf, xp), axis=1, keepdims=True), 0)
+    xp = np.where(np.isnan(xp), rowmax + 1, xp)
+    span = max(np.abs(xp).max(initial=0), np.abs(x).max(initial=0)) * 2 + 2
+    offsets = np.arange(len(xp))[:, np.newaxis] * span
+    idx = np.searchsorted((xp + offsets).ravel(), (x + offsets).ravel(), side='right').reshape(x.shape)
+    idx -= np.arange(len(xp))[:, np.newaxis] * xp.shape[1]
+
+    hi = np.clip(idx, 1, np.maximum(nvalid - 1, 1))
+    lo = hi - 1
+    xlo, xhi = np.take_along_axis(xp, lo, 1), np.take_along_axis(xp, hi, 1)
+    flo, fhi = np.take_along_axis(fp, lo, 1), np.take_along_axis(fp, hi, 1)
+    t = np.clip(np.where(xhi > xlo, (x - xlo) / np.where(xhi > xlo, xhi - xlo, 1), 0), 0, 1)
+    result = flo + t * np.where(nvalid > 1, fhi - flo, 0)
+    return np.where(nvalid > 0, result, np.nan)
+
+class PixelSketch:
+    """Per-pixel mergeable quantile sketch (rows are pixels)
+
+    Holds at most `size` weighted points per pixel, when full they are
+    replaced by `size // 2` evenly spaced (by weight) quantiles of
+    themselves. Exact while a pixel has seen no more than `size` values.
+    """
+
+    def __init__(self, npixels, size):
+        self.size = size
+        self.values = np.full((npixels, 0), np.nan)
+        self.weights = np.zeros((npixels, 0))
+
+    def update(self, values):
+        """Add (pixel, value) values, NaNs are ignored"""
+        values = np.concatenate([self.values, values], axis=1)
+        weights = np.concatenate([self.weights, (~np.isnan(values[:, self.values.shape[1]:])).astype(float)], axis=1)
+        # NaNs (no value) sort to the end of each row
+        order = np.argsort(values, axis=1, kind='stable')
+        values, weights = np.take_along_axis(values, order, 1), np.take_along_axis(weights, order, 1)
+        ncols = max(1, int((weights > 0).sum(axis=1).max(initial=0)))
+        values, weights = values[:, :ncols], weights[:, :ncols]
+
+        if ncols > self.size:
+            keep = self.size // 2
+            total = weights.sum(axis=1, keepdims=True)
+            mids = np.where(weights > 0, np.cumsum(weights, axis=1) - weights / 2, np.nan)
+            positions = (np.arange(keep) + 0.5) * total / keep
+            values = interp_rows(positions, mids, values)
+            weights = np.where(np.isnan(values), 0, np.broadcast_to(total / keep, values.shape))
+        self.values, self.weights = values, weights
+
+    def quantiles(self, quantiles):
+        """(quantile, pixel) array, as np.nanquantile's linear method when all weights are 1"""
+        total = self.weights.sum(axis=1, keepdims=True)
+        # mid-ranks, as the points were placed when compacting
+        positions = np.where(self.weights > 0, np.cumsum(self.weights, axis=1) - self.weights / 2, np.nan)
+        return interp_rows(np.asarray(quantiles)[np.newaxis] * (total - 1) + 0.5, positions, self.values).T
+
+class Reduction:
+    """Per-pixel statistics over many rasters, streamed a group of rasters at a time
+
+    The rasters must share a grid, each block is read from them directly
+    (--group-size rasters at once) into running count/sum/M2/min/max
+    accumulators and a PixelSketch for quantiles.
+    """
+
+    def __init__(self, rasters, stats, group_size, sketch, read_workers=0):
+        self.rasters = rasters
+        self.stats = stats
+        self.quantiles = [stat_quantile(stat) for stat in stats]
+        for stat, q in zip(stats, self.quantiles):
+            if q is None and stat not in REDUCE_STATS:
+                raise Exception(f"Unknown --reduce statistic '{stat}'")
+        self.group_size = group_size
+        self.sketch = sketch
+        self.nbands = gdal.Open(rasters[0]).RasterCount
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(read_workers) if read_workers > 0 else None
+
+    def working_bytes(self):
+        """Bytes per pixel used by block() on top of reading the rasters"""
+        # stacked float64 group and its (data - mean) ** 2 temporary, count/sum/mean/M2/min/max
+        nbytes = 2 * 8 * self.group_size + 6 * 8
+        if any(q is not None for q in self.quantiles):
+            # kept values/weights, then while merging a group: the concatenated
+            # values/weights, argsort indices, sorted copies and compaction temporaries
+            nbytes += 2 * 8 * self.sketch + 7 * 8 * (self.sketch + self.group_size)
+        return nbytes * self.nbands
+
+    def read(self, raster, xoff, yoff, xsize, ysize):
+        # open datasets are kept per thread, GDAL handles can't be shared between threads
+        handles = self.local.__dict__.setdefault('handles', {})
+        if raster not in handles:
+            handles[raster] = gdal.Open(raster)
+        ds = handles[raster]
+        data = ds.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float64).reshape(ds.RasterCount, ysize, xsize)
+        for b in range(ds.RasterCount):
+            nodata = ds.GetRasterBand(b + 1).GetNoDataValue()
+            if nodata is not None:
+                data[b][data[b] == nodata] = np.nan
+        return data
+
+    def block(self, xoff, yoff, xsize, ysize):
+        """(stat * band, y, x) float32 array of all stats for one block"""
+        count = total = mean = m2 = low = high = sketch = None
+        for start in range(0, len(self.rasters), self.group_size):
+            group = self.rasters[start:start + self.group_size]
+            read = lambda raster: self.read(raster, xoff, yoff, xsize, ysize)
+            data = np.stack(list(self.pool.map(read, group) if self.pool is not None else map(read, group)))
+            if count is None:
+                shape = data.shape[1:]
+                count, total, mean, m2 = np.zeros(shape), np.zeros(shape), np.zeros(shape), np.zeros(shape)
+                low, high = np.full(shape, np.nan), np.full(shape, np.nan)
+                if any(q is not None for q in self.quantiles):
+                    sketch = PixelSketch(int(np.prod(shape)), self.sketch)
+
+            # merge the group's count/mean/M2 into the running ones (Chan et al.)
+            n = (~np.isnan(data)).sum(axis=0)
+            group_sum = np.nansum(data, axis=0)
+            group_mean = group_sum / np.maximum(n, 1)
+            group_m2 = np.nansum((data - group_mean) ** 2, axis=0)
+            new_count = count + n
+            delta = group_mean - mean
+            mean += delta * n / np.maximum(new_count, 1)
+            m2 += group_m2 + delta ** 2 * count * n / np.maximum(new_count, 1)
+            count, total = new_count, total + group_sum
+            low = np.fmin(low, np.fmin.reduce(data, axis=0))
+            high = np.fmax(high, np.fmax.reduce(data, axis=0))
+            if sketch is not None:
+                sketch.update(data.reshape(len(data), -1).T)
+
+        empty = count == 0
+        results = {
+            'mean': np.where(empty, np.nan, total / np.maximum(count, 1)),
+            'var': np.where(empty, np.nan, m2 / np.maximum(count, 1)),
+            'sum': total, 'min': low, 'max': high, 'count': count,
+        }
+        results['std'] = np.sqrt(results['var'])
+        if sketch is not None:
+            quantiles = [q for q in self.quantiles if q is not None]
+            for q, values in zip(quantiles, sketch.quantiles(quantiles)):
+                results[q] = values.reshape(count.shape)
+        return np.concatenate([results[q if q is not None else stat]
+            for stat, q in zip(self.stats, self.quantiles)]).astype(np.float32)
+
+class BlockJournal:
+    """Finished output blocks of a run, kept in a directory next to the output
+
+    Each block is saved (atomically) as it is finished so a restarted run
+    can reuse it instead of recomputing. `fingerprint` identifies the run's
+    settings, a journal left by a run with different settings is discarded.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = Path(path)
+        meta = self.path / 'journal.json'
+        if self.path.exists() and (not meta.exists() or json.loads(meta.read_text()) != fingerprint):
+            print(f'WARN: discarding journal {self.path} from a run with different settings')
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta.write_text(json.dumps(fingerprint))
+        # partly written (.tmp) blocks are ignored
+        matches = (re.fullmatch(r'(\d+)_(\d+)\.npy', f.name) for f in self.path.iterdir())
+        self.done = {(int(m[1]), int(m[2])) for m in matches if m}
+
+    def _file(self, key):
+        return self.path / f'{key[0]}_{key[1]}.npy'
+
+    def load(self, key):
+        return np.load(self._file(key)) if key in self.done else None
+
+    def save(self, key, data):
+        tmp = self.path / f'{key[0]}_{key[1]}.tmp.npy'
+        np.save(tmp, data)
+        os.replace(tmp, self._file(key))
+
+    def close(self):
+        """Remove the journal once the output is complete"""
+        shutil.rmtree(self.path)
+
+def parse_partition(text):
+    """'i/N' -> (i, N), partitions are numbered from 0"""
+    match = re.fullmatch(r'(\d+)/(\d+)', text)
+    if match is None or not int(match[1]) < int(match[2]):
+        raise argparse.ArgumentTypeError(f"expected i/N with 0 <= i < N, got '{text}'")
+    return int(match[1]), int(match[2])
+
+def partition_path(result, i, n):
+    return result.with_name(f"{result.stem}_part{i:04d}of{n:04d}{result.suffix}")
+
+def merge_partitions(result, n, driver, nostats, nodata=None):
+    """Mosaic the n --partition tiles of result into result, with stats and pyramids
+
+    The tiles are gathered into a VRT, which is the output if result is a
+    .vrt, otherwise it is translated to result in `driver` format (e.g.
+    COG, which builds its own overviews).
+    """
+    tiles = [partition_path(result, i, n) for i in range(n)]
+    missing = [tile.as_posix() for tile in tiles if not tile.exists()]
+    if missing:
+        raise Exception(f"Missing partition tile(s): {' '.join(missing)}")
+
+    vrt = result if result.suffix.lower() == '.vrt' else result.with_suffix('.vrt')
+    ds = gdal.BuildVRT(vrt.as_posix(), [tile.as_posix() for tile in tiles])
+    first = gdal.Open(tiles[0].as_posix())
+    for b in range(1, ds.RasterCount + 1):
+        ds.GetRasterBand(b).SetDescription(first.GetRasterBand(b).GetDescription())
+        if nodata is not None:
+            ds.GetRasterBand(b).SetNoDataValue(nodata)
+    ds = first = None
+
+    if vrt != result:
+        print('MERGE:', vrt.as_posix(), '->', result.as_posix())
+        gdal.Translate(result.as_posix(), vrt.as_posix(), format=driver)
+        vrt.unlink()
+    if nostats:
+        return
+
+    ds = gdal.Open(result.as_posix(), gdal.GA_ReadOnly if driver in ('COG', 'VRT') or vrt == result else gdal.GA_Update)
+    if driver != 'COG':
+        factors = [2 ** i for i in range(1, 32) if max(ds.RasterXSize, ds.RasterYSize) // 2 ** i >= 256]
+        ds.BuildOverviews('NEAREST', factors, callback=gdal.TermProgress_nocb)
+    for b in range(1, ds.RasterCount + 1):
+        ds.GetRasterBand(b).ComputeStatistics(False)
+    ds = None
 
 # argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('result', type=Path)
-parser.add_argument('rasters', type=Path, nargs='+')
-parser.add_argument('--calc', type=str, default="np.nanmean(rasters, axis=0)", help="Formula to apply, raster(s) available np array 'rasters', numpy is available as 'np'")
-parser.add_argument('--calcmask', type=str, default=None, help="Mask formula to apply, raster(s) available np array 'rasters', numpy is available as 'np'")
+parser.add_argument('rasters', type=Path, nargs='*')
+parser.add_argument('--input', type=parse_input, nargs='+', default=[], help="Named input(s) as name=file[:band,band...], available as 3D np arrays 'name' (band, x, y) holding only the given bands")
+parser.add_argument('--calc', type=str, default="np.nanmean(rasters, axis=0)", help="Formula to apply, raster(s) available np array 'rasters' and named --input arrays, numpy is available as 'np'")
+parser.add_argument('--calcmask', type=str, default=None, help="Mask formula to apply, raster(s) available np array 'rasters' and named --input arrays, numpy is available as 'np'")
+parser.add_argument('--backend', choices=['numpy', 'numexpr'], default='numpy', help="Evaluate elementwise formulas with NumPy or numexpr (multithreaded, fused, if installed). numexpr results are cast to the data type NumPy would give, but small integer inputs are upcast first so intermediate results don't wrap around as in NumPy")
 parser.add_argument('-of', type=str, default='KEA')
 parser.add_argument('--nostats', action='store_true', help='Do NOT calculate pyramids/stats')
 parser.add_argument('--dstnodata', type=str, help="Destination NODATA value (either a number or 'np.nan'")
 parser.add_argument('--bandnames', nargs='+', default=None)
+parser.add_argument('--workers', type=int, default=1, help='Number of compute threads to process blocks with concurrently (needs rios >= 2)')
+parser.add_argument('--read-workers', type=int, default=0, help='Number of threads reading blocks ahead of the compute workers (needs rios >= 2)')
+parser.add_argument('--skipmask', type=str, default=None, help="AOI raster (same grid as the inputs, pixels > 0 inside) or vector file, blocks entirely outside it (or entirely nodata) are filled with nodata without running --calc")
+parser.add_argument('--reduce', nargs='+', default=None, help=f"Instead of --calc, stream 'rasters' a group at a time into per-pixel statistics: {', '.join(REDUCE_STATS)}, median, percNN, quantQ (quantiles from a --sketch per pixel)")
+parser.add_argument('--group-size', type=int, default=16, help='Number of rasters read at once with --reduce')
+parser.add_argument('--sketch', type=int, default=64, help='Points kept per pixel and band for --reduce quantiles, exact up to this many rasters')
+parser.add_argument('--resume', action='store_true', help="Journal finished blocks next to result (result.journal/) and reuse any from an interrupted run with the same arguments, so only the remaining blocks are computed. The journal is removed when the run completes")
+parser.add_argument('--partition', type=parse_partition, default=None, help="Process only partition i of N (i/N, from 0) of the block rows, written to result_part<i>of<N> without stats/pyramids, combine them with --merge N")
+parser.add_argument('--merge', type=int, default=None, help="Mosaic the N partition tiles of result (from --partition i/N runs) into result (.vrt, or -of format e.g. COG) with stats and pyramids, no calculation is done")
+parser.add_argument('--mem-budget', type=float, default=None, help="Memory budget (MB) for blocks in flight, sets the window size from the number of inputs, bands and data types [default: rios' window size]")
 args = parser.parse_args()
 
+if args.merge is not None:
+    merge_partitions(args.result, args.merge, args.of, args.nostats, parse_nodata(args.dstnodata) if args.dstnodata is not None else None)
+    print("Done")
+    sys.exit(0)
+
 # rios
 controls = applier.ApplierControls()
 infiles = applier.FilenameAssociations()
 outfiles = applier.FilenameAssociations()
 otherargs = applier.OtherInputs()
 
-finfo = fileinfo.ImageInfo(args.rasters[0].as_posix())
+# inputs as name -> (file(s), bands), only those the formulas use are read
+inputs = {name: (path, bands) for name, path, bands in args.input}
+if args.rasters:
+    inputs['rasters'] = ([x.as_posix() for x in args.rasters], None)
+
+# of inputs only indexed with constants, just those rasters/bands are read and
+# the formulas are renumbered to match, e.g. rasters[5] -> rasters[1]
+calc, calcmask = args.calc, args.calcmask
+if args.reduce is None:
+    positions = {}
+    for name, indices in constant_indices([x for x in (calc, calcmask) if x is not None]).items():
+        if name not in inputs:
+            continue
+        paths, bands = inputs[name]
+        if name == 'rasters':
+            assert indices[-1] < len(paths), f"--calc uses rasters[{indices[-1]}] but there are only {len(paths)} rasters"
+            inputs[name] = ([paths[i] for i in indices], bands)
+        else:
+            assert bands is None or indices[-1] < len(bands), f"--calc uses {name}[{indices[-1]}] but only bands {bands} are selected"
+            inputs[name] = (paths, [bands[i] if bands is not None else i + 1 for i in indices])
+        positions[name] = {i: k for k, i in enumerate(indices)}
+        print(f'Reading only {name}{indices}')
+    if positions:
+        calc = reindex(calc, positions)
+        calcmask = reindex(calcmask, positions) if calcmask is not None else None
+
+otherargs.formula = Expression(calc, args.backend)
+otherargs.calcmask = Expression(calcmask, args.backend) if calcmask is not None else None
+used = otherargs.formula.names | (otherargs.calcmask.names if otherargs.calcmask is not None else set())
+if args.reduce is not None:
+    assert args.calcmask is None or otherargs.calcmask.names <= {'np', 'result'}, "--calcmask can only use 'result' with --reduce"
+    used = {'rasters'}
+for name in inputs.keys() - used:
+    print(f'Skipping unused input: {name}')
+inputs = {name: value for name, value in inputs.items() if name in used}
+if not inputs:
+    raise Exception("--calc doesn't use any inputs, expected 'rasters' and/or --input names")
+rasters = [(path, bands) for paths, bands in inputs.values() for path in (paths if isinstance(paths, list) else [paths])]
+
+finfo = fileinfo.ImageInfo(rasters[0][0])
+
+otherargs.reduction = None
+if args.reduce is not None:
+    assert args.rasters, "--reduce needs 'rasters'"
+    for raster, _ in rasters[1:]:
+        info = fileinfo.ImageInfo(raster)
+        assert (info.ncols, info.nrows, info.rasterCount) == (finfo.ncols, finfo.nrows, finfo.rasterCount), f"--reduce rasters should all have the same grid and bands ({raster})"
+    otherargs.reduction = Reduction([raster for raster, _ in rasters], args.reduce, args.group_size, args.sketch, args.read_workers)
+    # rios only needs a (small) reference input to drive the blocks, the rasters are read by Reduction
+    inputs = {'reference': (rasters[0][0], [1])}
+    bandnames = args.bandnames or [f"b{b + 1:02d}" for b in range(finfo.rasterCount)]
+    args.bandnames = [f"{stat}_{name}" for stat in args.reduce for name in bandnames]
 
 # rios options
 controls.drivername = args.of
@@ -50,29 +585,126 @@ if args.bandnames is not None:
     controls.layernames = args.bandnames # ['LST_Day_1km', 'LST_Night_1km']
 
 if args.dstnodata is not None:
-    controls.statsignore = int(args.dstnodata) if '.' not in args.dstnodata else np.nan if args.dstnodata == "np.nan" else float(args.dstnodata)
+    controls.statsignore = parse_nodata(args.dstnodata)
 else:
     controls.statsignore = finfo.nodataval
+
+if args.workers > 1 or args.read_workers > 0:
+    if not hasattr(applier, 'ConcurrencyStyle'):
+        print('WARN: rios >= 2 is needed for --workers/--read-workers, processing serially')
+    else:
+        # threads, so compiled formulas are shared and NumPy/numexpr release the GIL
+        controls.setConcurrencyStyle(applier.ConcurrencyStyle(
+            numReadWorkers=args.read_workers, numComputeWorkers=args.workers if args.workers > 1 else 0,
+            computeWorkerKind=applier.CW_THREADS if args.workers > 1 else applier.CW_NONE))
+        # share the cores between compute workers rather than oversubscribing
+        if ne is not None and args.workers > 1:
+            ne.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+
+if args.mem_budget is not None:
+    # each worker holds a block, plus the read-ahead and the one being written
+    winsize = window_size(rasters if args.reduce is None else rasters[:args.group_size], args.mem_budget * 1024 ** 2,
+        args.workers + args.read_workers + 1, max(finfo.nrows, finfo.ncols),
+        extra_bytes=otherargs.reduction.working_bytes() if otherargs.reduction is not None else 0)
+    controls.windowxsize = winsize
+    controls.windowysize = winsize
 print("WINSIZE", controls.windowxsize, controls.windowysize)
 
+otherargs.yblock0 = 0
+if args.partition is not None:
+    # a block-aligned range of rows of the reference grid, as its own tile
+    i, n = args.partition
+    nyblocks = -(-finfo.nrows // controls.windowysize)
+    assert n <= nyblocks, f"--partition: can't split {nyblocks} block rows into {n} partitions"
+    yblock0, yblock1 = i * nyblocks // n, (i + 1) * nyblocks // n
+    row0, row1 = yblock0 * controls.windowysize, min(yblock1 * controls.windowysize, finfo.nrows)
+    x0, xres, xrot, y0, yrot, yres = finfo.transform
+    controls.setReferencePixgrid(pixelgrid.PixelGridDefn(geotransform=(x0, xres, xrot, y0 + row0 * yres, yrot, yres),
+        nrows=row1 - row0, ncols=finfo.ncols, projection=finfo.projection))
+    controls.setFootprintType(applier.BOUNDS_FROM_REFERENCE)
+    # done once over the mosaic by --merge
+    controls.calcStats = False
+    args.result = partition_path(args.result, i, n)
+    otherargs.yblock0 = yblock0
+    print(f'PARTITION: {i}/{n}, rows {row0} - {row1}')
+
+otherargs.valid = None
+if args.skipmask is not None:
+    otherargs.valid = block_validity(args.skipmask, finfo, controls.windowxsize, controls.windowysize)
+    print(f'SKIPMASK: {otherargs.valid.sum()} of {otherargs.valid.size} blocks to process')
+
 # rios files
-infiles.rasters = [x.as_posix() for x in args.rasters]
+for name, (paths, bands) in inputs.items():
+    setattr(infiles, name, paths)
+    if bands is not None:
+        controls.selectInputImageLayers(bands, imagename=name)
+    print(f'IN  - {name}:', paths if isinstance(paths, str) else f'{len(paths)} rasters', '' if bands is None else f'bands {bands}')
 outfiles.result = args.result.as_posix()
 #print('IN:',infiles.raw)
 print('OUT:',outfiles.result)
 
-otherargs.formula = args.calc
-otherargs.calcmask = args.calcmask
+otherargs.inputs = list(inputs)
+otherargs.winsize = (controls.windowxsize, controls.windowysize)
 otherargs.nodata = controls.statsignore
+fill = otherargs.nodata[0] if isinstance(otherargs.nodata, (list, tuple)) else otherargs.nodata
+otherargs.fill = 0 if fill is None else fill
+if args.reduce is not None:
+    print('REDUCE:', ' '.join(args.reduce), f'over {len(args.rasters)} rasters, {args.group_size} at a time')
+for name, expression in [('CALC', otherargs.formula if args.reduce is None else None), ('CALCMASK', otherargs.calcmask)]:
+    if expression is not None:
+        print(f"{name}:", expression.source, "(numexpr)" if expression.numexpr is not None else "(numpy)")
+
+otherargs.journal = None
+if args.resume:
+    # anything that changes the output values, not how they are computed
+    fingerprint = {k: str(v) for k, v in sorted(vars(args).items()) if k not in ('workers', 'read_workers', 'resume', 'nostats')}
+    fingerprint['winsize'] = list(otherargs.winsize)
+    otherargs.journal = BlockJournal(args.result.as_posix() + '.journal', fingerprint)
+    if otherargs.journal.done:
+        print(f'RESUME: reusing {len(otherargs.journal.done)} finished blocks from {otherargs.journal.path}')
 
 # rios apply function
 def apply(info, ins, outs, others):
-    outs.result = eval(others.formula, {"rasters": ins.rasters, "np": np})
+    names = {name: getattr(ins, name) for name in others.inputs}
+    # block row in the whole grid, when processing a --partition
+    yblock = info.yblock + others.yblock0
+    skip = others.valid is not None and not others.valid[yblock, info.xblock]
+    # 'rasters' is a list of arrays, so the block size comes from rios
+    xsize, ysize = info.getBlockSize()
+
+    key = (info.yblock, info.xblock)
+    if others.journal is not None and not skip:
+        done = others.journal.load(key)
+        if done is not None:
+            outs.result = done
+            return
+
+    if others.reduction is not None:
+        if skip:
+            nbands = len(others.reduction.stats) * others.reduction.nbands
+            outs.result = np.full((nbands, ysize, xsize), others.fill, dtype=np.float32)
+            return
+        # rios blocks are laid out from the top left of the (shared) grid
+        outs.result = others.reduction.block(info.xblock * others.winsize[0], yblock * others.winsize[1], xsize, ysize)
+        names = {}
+    # nothing to calculate outside the AOI, the formula on a single pixel gives the output bands/type
+    elif skip:
+        sample = others.formula(**{name: first_pixel(value) for name, value in names.items()})
+        fill = others.fill if sample.dtype.kind == 'f' or not np.isnan(others.fill) else 0
+        outs.result = np.full(sample.shape[:-2] + (ysize, xsize), fill, dtype=sample.dtype)
+        return
+    else:
+        outs.result = others.formula(**names)
     
     if others.calcmask is not None:
-        outs.result[eval(others.calcmask, {"rasters": ins.rasters, "np": np, "result": outs.result})] = others.nodata
+        outs.result[others.calcmask(result=outs.result, **names)] = others.nodata
+
+    if others.journal is not None:
+        others.journal.save(key, outs.result)
 
 # rios execute
 applier.apply(apply, infiles, outfiles, otherargs, controls=controls)
+if otherargs.journal is not None:
+    otherargs.journal.close()
 
 print("Done")
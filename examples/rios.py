@@ -62,7 +62,7 @@ def apply(info, ins, outs, others):
 
     outs.output = np.zeros_like(ins.raster1, dtype=float)
 
-    valid = np.ones_like((1,) + ins.raster1.shape[1:], dtype=bool)
+    valid = np.ones((1,) + ins.raster1.shape[1:], dtype=bool)
 
     if others.mask:
         valid *= ins.mask == 1